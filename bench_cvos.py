@@ -0,0 +1,599 @@
+"""Benchmarks for cvos.py
+
+    python3 bench_cvos.py startup
+    python3 bench_cvos.py commands --shape wide --latency 0.02
+
+The commands benchmark runs cvos.py against FakeClient, an in-memory
+stand-in for vos.Client with a per-call latency and a bandwidth limit, so
+no CANFAR service is needed.
+"""
+import typer
+import sys
+import os
+import json
+import logging
+import fnmatch
+import hashlib
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+app = typer.Typer()
+
+
+@app.callback()
+def main():
+    """Benchmarks for cvos.py"""
+
+
+CVOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cvos.py')
+
+
+def _import_times(stderr):
+    """Parse `python -X importtime` output into ({module: cumulative_us}, total_us)"""
+    modules = {}
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+        # only top level imports count towards the total, nested ones are
+        # already included in their parent's cumulative time
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+    return modules, total
+
+
+# a run of one command in a fresh interpreter: cvos is imported, then the
+# command runs against a FakeClient holding a tiny tree, or with no command
+# the real client is created, and the two steps are timed separately
+_STUB = """
+import json, sys, time
+start = time.perf_counter()
+import cvos
+imported = time.perf_counter()
+root, tmp, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+if args:
+    sys.path.insert(0, root)
+    import bench_cvos
+    client = bench_cvos.FakeClient()
+    client.add('stub/a.fits', 2880)
+    client.add('stub/dir/b.fits', 2880)
+    cvos._vos_client = lambda: client
+    args = [arg.format(tmp=tmp) for arg in args]
+    step = time.perf_counter()
+    result = cvos.app(args, standalone_mode=False)
+    error = None if not result else 'exit status {}'.format(result)
+else:
+    step = time.perf_counter()
+    try:
+        cvos._vos_client()
+        error = None
+    except Exception as ex:
+        error = repr(ex)
+print(json.dumps({'import_ms': (imported - start) * 1000,
+                  'run_ms': (time.perf_counter() - step) * 1000,
+                  'error': error}))
+"""
+
+# the stub run of each command, {tmp} is a scratch directory
+STARTUP_RUNS = [
+    ('(client)', []),
+    ('ls', ['ls', '-l', 'vos:stub']),
+    ('cp', ['cp', 'vos:stub/a.fits', '{tmp}/a.fits']),
+    ('rm', ['rm', 'vos:stub/a.fits']),
+    ('mkdir', ['mkdir', 'vos:stub/new']),
+    ('mv', ['mv', 'vos:stub/a.fits', 'vos:stub/moved.fits']),
+    ('du', ['du', 'vos:stub']),
+    ('find', ['find', 'vos:stub', '--type', 'f']),
+    ('headers', ['headers', 'vos:stub/a.fits', '-k', 'NAXIS', '-o',
+                 '{tmp}/headers.csv']),
+    ('index', ['index', 'refresh', 'vos:stub', '--index', '{tmp}/index.sqlite']),
+    ('hash-index', ['hash-index', '{tmp}', '--index', '{tmp}/md5.sqlite']),
+    ('batch', ['batch', '{tmp}/manifest']),
+]
+
+
+def _run_startup(args):
+    """Run the stub for args with `python -X importtime` in a scratch
+    cache, returns (wall, import_ms, run_ms, error, modules)"""
+    tmp = tempfile.mkdtemp(prefix='cvos-startup-')
+    try:
+        with open(os.path.join(tmp, 'manifest'), 'w') as f:
+            f.write('mkdir vos:stub/batch\n')
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmp, 'cache'))
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', _STUB,
+             os.path.dirname(CVOS), tmp] + args,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            env=env)
+        wall = time.perf_counter() - start
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    modules, _ = _import_times(result.stderr)
+    # the fake service is not part of the cost being measured
+    modules.pop('bench_cvos', None)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode or not lines:
+        error = result.stderr.strip().splitlines()[-1:] or ['no output']
+        return wall, None, None, error[0], modules
+    times = json.loads(lines[-1])
+    return wall, times['import_ms'], times['run_ms'], times['error'], modules
+
+
+@app.command()
+def startup(
+    repeat: int = typer.Option(5, "-n", "--repeat", help="number of cold starts per command"),
+    top: int = typer.Option(5, "--top", help="show the slowest imports of each command"),
+    json_output: bool = typer.Option(False, "--json", help="print results as JSON")
+):
+    """Measure the cold-start cost of each command.
+
+    Every command runs once in a fresh interpreter against a FakeClient,
+    so the imports it does on first use are counted; (client) is the
+    creation of the real client.  `import ms` is the time of `import
+    cvos`, `run ms` that of the command (or client) afterwards."""
+    results = []
+    for command, args in STARTUP_RUNS:
+        walls = []
+        imports = []
+        runs = []
+        modules = {}
+        error = None
+        for _ in range(repeat):
+            wall, import_ms, run_ms, error, modules = _run_startup(args)
+            if import_ms is None:
+                break
+            walls.append(wall)
+            imports.append(import_ms)
+            runs.append(run_ms)
+        if error is not None:
+            logging.warning("{}: {}".format(command, error))
+        if not walls:
+            continue
+        slowest = sorted(modules.items(), key=lambda m: m[1], reverse=True)
+        results.append({'command': command,
+                        'wall_ms': statistics.median(walls) * 1000,
+                        'import_ms': statistics.median(imports),
+                        'run_ms': statistics.median(runs),
+                        'error': error,
+                        'slowest': [name for name, _ in slowest[:top]]})
+
+    if json_output:
+        typer.echo(json.dumps(results, indent=2))
+        return
+    typer.echo("{:<10} {:>10} {:>10} {:>10}  {}".format(
+        'command', 'wall ms', 'import ms', 'run ms', 'slowest imports'))
+    for r in results:
+        typer.echo("{:<10} {:>10.1f} {:>10.1f} {:>10.1f}  {}".format(
+            r['command'], r['wall_ms'], r['import_ms'], r['run_ms'],
+            ', '.join(r['slowest'])))
+
+
+class FakeClient(object):
+    """In-memory VOSpace with the parts of the vos.Client API cvos.py uses.
+
+    Every call that would be a request to the service sleeps for latency
+    seconds and is counted in calls; data moves at bandwidth bytes per
+    second.  File contents are zeros so only sizes are stored.  The
+    sessions from get_session take uploads and run copy jobs, or refuse
+    every job with copy_status (e.g. 405 or 501) as the service would.
+    """
+
+    AUTHORITY = 'vos://cadc.nrc.ca~vault/'
+    DATE = '2024-01-01T00:00:00.000'
+    TRANSFERS = 'https://ws.fake/vault/transfers'
+
+    def __init__(self, latency=0.0, bandwidth=None, copy_status=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.copy_status = copy_status
+        # job URL -> (source path, destination path)
+        self.jobs = {}
+        self.calls = {}
+        self.bytes = 0
+        # path -> ('d', None) | ('f', size) | ('l', target)
+        self.tree = {'': ('d', None)}
+        # worker threads of cvos.py change the tree concurrently
+        self._lock = threading.RLock()
+        self._md5s = {}
+
+    def _call(self, name, size=0):
+        """Count a request and wait for its latency and transfer time"""
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.bytes += size
+        delay = self.latency
+        if size and self.bandwidth:
+            delay += size / float(self.bandwidth)
+        if delay:
+            time.sleep(delay)
+
+    def _md5(self, size):
+        with self._lock:
+            if size not in self._md5s:
+                self._md5s[size] = hashlib.md5(bytes(size)).hexdigest()
+            return self._md5s[size]
+
+    @staticmethod
+    def _path(uri):
+        return urlparse(uri).path.strip('/')
+
+    def _children(self, path):
+        prefix = path + '/' if path else ''
+        return sorted(p for p in self.tree if p.startswith(prefix) and p != path
+                      and '/' not in p[len(prefix):])
+
+    def _subtree(self, path):
+        return [p for p in self.tree if p == path or p.startswith(path + '/')]
+
+    def _node(self, path):
+        from vos.vos import Node
+        from cadcutils import exceptions
+        if path not in self.tree:
+            raise exceptions.NotFoundException(path)
+        kind, value = self.tree[path]
+        props = {'date': self.DATE}
+        if kind == 'd':
+            return Node(self.fix_uri(path), node_type=Node.CONTAINER_NODE,
+                        properties=props)
+        if kind == 'l':
+            node = Node(self.fix_uri(path), node_type=Node.LINK_NODE,
+                        properties=props)
+            node.target = value
+            return node
+        props.update({'length': str(value), 'MD5': self._md5(value)})
+        return Node(self.fix_uri(path), node_type=Node.DATA_NODE,
+                    properties=props)
+
+    def add(self, path, size=None):
+        """Add a file of size bytes (a container if size is None) and any
+        missing parents"""
+        parts = path.split('/')
+        with self._lock:
+            for i in range(1, len(parts)):
+                self.tree.setdefault('/'.join(parts[:i]), ('d', None))
+            self.tree[path] = ('d', None) if size is None else ('f', size)
+
+    # vos.Client API
+
+    def is_remote_file(self, file_name):
+        return file_name.startswith('vos:')
+
+    def fix_uri(self, uri):
+        return self.AUTHORITY + self._path(uri)
+
+    def glob(self, pathname):
+        self._call('glob')
+        pattern = self._path(pathname)
+        with self._lock:
+            return [self.fix_uri(p) for p in sorted(self.tree)
+                    if fnmatch.fnmatch(p, pattern)
+                    and p.count('/') == pattern.count('/')]
+
+    def get_node(self, uri, limit=0, force=False):
+        self._call('get_node')
+        with self._lock:
+            return self._node(self._path(uri))
+
+    def get_children_info(self, uri, sort=None, order=None, force=False):
+        self._call('get_children_info')
+        path = self._path(uri)
+        with self._lock:
+            if self._node(path).type != 'vos:ContainerNode':
+                return [self._node(path)]
+            return [self._node(child) for child in self._children(path)]
+
+    def listdir(self, uri, force=False):
+        self._call('listdir')
+        with self._lock:
+            return [child.rsplit('/', 1)[-1] for child in
+                    self._children(self._path(uri))]
+
+    def isdir(self, uri):
+        self._call('isdir')
+        with self._lock:
+            return self.tree.get(self._path(uri), ('',))[0] == 'd'
+
+    def isfile(self, uri):
+        self._call('isfile')
+        with self._lock:
+            return self.tree.get(self._path(uri), ('',))[0] == 'f'
+
+    def access(self, uri, mode=os.O_RDONLY):
+        self._call('access')
+        with self._lock:
+            return self._path(uri) in self.tree
+
+    def mkdir(self, uri):
+        from cadcutils import exceptions
+        self._call('mkdir')
+        path = self._path(uri)
+        with self._lock:
+            if path in self.tree:
+                raise exceptions.AlreadyExistsException(path)
+            self.tree[path] = ('d', None)
+
+    def delete(self, uri):
+        self._call('delete')
+        path = self._path(uri)
+        with self._lock:
+            if self._children(path):
+                raise OSError("{} is not empty".format(path))
+            self._node(path)
+            del self.tree[path]
+
+    def recursive_delete(self, uri):
+        self._call('recursive_delete')
+        with self._lock:
+            doomed = self._subtree(self._path(uri))
+            for p in doomed:
+                del self.tree[p]
+        return len(doomed), 0
+
+    def move(self, src_uri, destination_uri):
+        self._call('move')
+        src = self._path(src_uri)
+        dest = self._path(destination_uri)
+        with self._lock:
+            if self.tree.get(dest, ('',))[0] == 'd':
+                dest = dest + '/' + src.rsplit('/', 1)[-1]
+            for p in self._subtree(src):
+                self.tree[dest + p[len(src):]] = self.tree.pop(p)
+
+    def copy(self, source, destination, send_md5=False, disposition=False,
+             head=None):
+        if self.is_remote_file(source):
+            with self._lock:
+                size = self.tree[self._path(source)][1]
+            self._call('copy', size)
+            if os.path.isdir(destination):
+                destination = os.path.join(destination,
+                                           os.path.basename(source))
+            with open(destination, 'wb') as f:
+                f.truncate(size)
+        else:
+            size = os.path.getsize(source)
+            self._call('copy', size)
+            with self._lock:
+                self.tree[self._path(destination)] = ('f', size)
+        return self._md5(size) if send_md5 else size
+
+    def open(self, uri, mode=os.O_RDONLY, view=None, byte_range=None, **kwargs):
+        self._call('open')
+        with self._lock:
+            size = self.tree[self._path(uri)][1]
+        return _FakeFile(self, size, byte_range)
+
+    def get_session(self, uri):
+        return _FakeSession(self)
+
+    def get_endpoints(self, uri):
+        class Endpoints(object):
+            async_transfer = self.TRANSFERS
+        return Endpoints()
+
+    def get_node_url(self, uri, method='GET', full_negotiation=None, **kwargs):
+        self._call('get_node_url')
+        return [self.fix_uri(uri), None]
+
+    def get_transfer_error(self, url, uri):
+        from cadcutils import exceptions
+        raise exceptions.TransferException("copy job {} failed".format(url))
+
+
+class _FakeResponse(object):
+    """The parts of a requests.Response that cvos.py reads"""
+
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        import requests
+        if self.status_code >= 400:
+            raise requests.HTTPError("{} error".format(self.status_code),
+                                     response=self)
+
+
+class _FakeSession(object):
+    """The cadcutils RetrySession of FakeClient.get_session.  Errors are
+    raised as cadcutils exceptions, like RetrySession.check_status"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def _check(self, response):
+        from cadcutils import exceptions
+        try:
+            response.raise_for_status()
+        except Exception as ex:
+            if response.status_code == 400:
+                raise exceptions.BadRequestException(orig_exception=ex)
+            raise exceptions.UnexpectedException(orig_exception=ex)
+        return response
+
+    def post(self, url, data=None, **kwargs):
+        from xml.etree import ElementTree
+        client = self.client
+        client._call('post')
+        if url == client.TRANSFERS:
+            if client.copy_status is not None:
+                return self._check(_FakeResponse(
+                    client.copy_status, "copyNode not supported"))
+            transfer = ElementTree.fromstring(data)
+            source, destination = [element.text for element in transfer][:2]
+            with client._lock:
+                job_url = '{}/{}'.format(client.TRANSFERS, len(client.jobs))
+                client.jobs[job_url] = (client._path(source),
+                                        client._path(destination))
+            return _FakeResponse(303, headers={'Location': job_url})
+        # PHASE=RUN, the copy is done straight away
+        source, destination = client.jobs[url[:-len('/phase')]]
+        with client._lock:
+            client.tree[destination] = client.tree[source]
+        return _FakeResponse(200)
+
+    def get(self, url, **kwargs):
+        self.client._call('get')
+        return _FakeResponse(200, 'COMPLETED')
+
+    def put(self, url, data=None, **kwargs):
+        size = len(data)
+        for _ in data:
+            pass
+        self.client._call('put', size)
+        with self.client._lock:
+            self.client.tree[self.client._path(url)] = ('f', size)
+        return _FakeResponse(201)
+
+
+class _FakeFile(object):
+    """The VOFile returned by FakeClient.open"""
+
+    def __init__(self, client, size, byte_range):
+        self.client = client
+        self.size = size
+        self.byte_range = byte_range
+        self.status_code = 200
+
+    def read(self, size=None, return_response=False):
+        start, end = 0, self.size
+        if self.byte_range:
+            first, last = self.byte_range[len('bytes='):].split('-')
+            start, end = int(first), int(last) + 1 if last else self.size
+            self.status_code = 206
+        self.length = end - start
+        self.client._call('read', self.length)
+        return self if return_response else bytes(self.length)
+
+    def iter_content(self, chunk_size):
+        for offset in range(0, self.length, chunk_size):
+            yield bytes(min(chunk_size, self.length - offset))
+
+    def close(self):
+        pass
+
+
+# name -> (containers, files per container, file size, depth)
+SHAPES = {'wide': (1, 2000, 1024, 1),
+          'deep': (1, 4, 1024, 40),
+          'small': (50, 100, 512, 1),
+          'huge': (1, 4, 64 * 1024 * 1024, 1)}
+
+
+def _build_tree(client, root, shape):
+    """Fill client with a tree of the given shape under root"""
+    containers, files, size, depth = SHAPES[shape]
+    for c in range(containers):
+        path = '{}/c{:04d}'.format(root, c)
+        for level in range(depth):
+            for f in range(files):
+                client.add('{}/f{:05d}.fits'.format(path, f), size)
+            path += '/d{:03d}'.format(level)
+
+
+def _build_local_tree(root, shape):
+    """Write the tree _build_tree describes to root on local disk"""
+    containers, files, size, depth = SHAPES[shape]
+    for c in range(containers):
+        path = os.path.join(root, 'c{:04d}'.format(c))
+        for level in range(depth):
+            os.makedirs(path, exist_ok=True)
+            for f in range(files):
+                with open(os.path.join(path, 'f{:05d}.fits'.format(f)), 'wb') as fh:
+                    fh.truncate(size)
+            path = os.path.join(path, 'd{:03d}'.format(level))
+
+
+def _scenarios(jobs):
+    """(name, argv, tree needed before the run, FakeClient options) for
+    each benchmark"""
+    j = ['--jobs', str(jobs)]
+    return [('ls', ['ls', '-l', 'vos:bench/*'], True, {}),
+            ('cp download', ['cp', 'vos:bench', '{local}/download'] + j,
+             True, {}),
+            ('cp upload', ['cp', '{local}/bench', 'vos:upload'] + j, False, {}),
+            ('cp remote', ['cp', 'vos:bench', 'vos:copy'] + j, True, {}),
+            # services without copyNode, the files are streamed instead
+            ('cp remote 405', ['cp', 'vos:bench', 'vos:copy'] + j, True,
+             {'copy_status': 405}),
+            ('cp remote 501', ['cp', 'vos:bench', 'vos:copy'] + j, True,
+             {'copy_status': 501}),
+            ('mkdir -p', ['mkdir', '-p', 'vos:made/' + '/'.join(
+                'd{}'.format(i) for i in range(20))], False, {}),
+            ('mv', ['mv', 'vos:bench', 'vos:moved'], True, {}),
+            ('rm -R', ['rm', '-R', 'vos:bench'] + j, True, {})]
+
+
+@app.command()
+def commands(
+    shape: str = typer.Option('small', "--shape", help="tree shape: " + ", ".join(SHAPES)),
+    latency: float = typer.Option(0.01, "--latency", help="seconds added to every service call"),
+    bandwidth: str = typer.Option('100M', "--bandwidth", help="bytes per second moved by copy and ranged reads"),
+    jobs: int = typer.Option(8, "-j", "--jobs", help="--jobs passed to cp, ls and rm"),
+    only: str = typer.Option(None, "--only", help="comma separated scenario names to run"),
+    json_output: bool = typer.Option(False, "--json", help="print results as JSON")
+):
+    """Run cvos.py commands against an in-memory VOSpace and report
+    round trips, wall time and throughput."""
+    from typer.testing import CliRunner
+    sys.path.insert(0, os.path.dirname(CVOS))
+    import cvos
+
+    if shape not in SHAPES:
+        raise typer.BadParameter("unknown shape {}".format(shape),
+                                 param_hint="--shape")
+    # cvos.py logs from worker threads; keep that off the runner's streams
+    logging.getLogger().addHandler(logging.NullHandler())
+    results = []
+    local = tempfile.mkdtemp(prefix='bench_cvos')
+    try:
+        for name, argv, needs_tree, options in _scenarios(jobs):
+            if only and name not in only.split(','):
+                continue
+            client = FakeClient(latency, cvos._parse_size(bandwidth), **options)
+            if needs_tree:
+                _build_tree(client, 'bench', shape)
+            if name == 'cp upload':
+                upload = os.path.join(local, 'bench')
+                if not os.path.isdir(upload):
+                    _build_local_tree(upload, shape)
+            # built by get_client, so the calls go through the retry (and
+            # with --profile the profiling) proxies as they would for real
+            cvos._vos_client = lambda: client
+            cvos._client = None
+            cvos._node_cache = None
+            start = time.perf_counter()
+            result = CliRunner().invoke(
+                cvos.app, [arg.format(local=local) for arg in argv])
+            wall = time.perf_counter() - start
+            if result.exit_code:
+                typer.echo("{} failed: {}".format(name, result.output), err=True)
+            results.append({'scenario': name, 'wall_s': wall,
+                            'round_trips': sum(client.calls.values()),
+                            'calls': client.calls,
+                            'mb': client.bytes / 1e6,
+                            'mb_s': client.bytes / 1e6 / wall})
+    finally:
+        shutil.rmtree(local)
+
+    if json_output:
+        typer.echo(json.dumps(results, indent=2))
+        return
+    typer.echo("{:<12} {:>8} {:>11} {:>9} {:>8}".format(
+        'scenario', 'wall s', 'round trips', 'MB', 'MB/s'))
+    for r in results:
+        typer.echo("{:<12} {:>8.2f} {:>11} {:>9.1f} {:>8.1f}".format(
+            r['scenario'], r['wall_s'], r['round_trips'], r['mb'], r['mb_s']))
+
+
+if __name__ == "__main__":
+    app()
@@ -1,8 +1,4 @@
 import typer
-from canfar.context import Context
-import vos
-from vos.vos import SortNodeProperty, CADC_GMS_PREFIX, convert_vospace_time_to_seconds
-from vos import md5_cache
 import sys
 import time
 import math
@@ -11,17 +7,1636 @@ import errno
 import os
 import re
 import glob
+import fnmatch
 import warnings
-from cadcutils import exceptions
+import csv
+import json
+from enum import Enum
+import shutil
+import threading
+import collections
+import contextlib
+import hashlib
+import functools
+import random
+import mmap
+import sqlite3
+import concurrent.futures
 from urllib.parse import urlparse
 
-context = Context()
-active_context = context.config.active
-ctx = context.config.contexts[active_context]
-token = ctx.token.access
-client=vos.Client(vospace_token=token)
+app = typer.Typer()
+
+# Defaults for retrying failed VOSpace calls
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# consecutive failures, across all threads, that pause every call
+BREAKER_THRESHOLD = 10
+BREAKER_COOLDOWN = 30.0
+
+
+class RetryPolicy(object):
+    """Retry transient VOSpace errors with exponential backoff and jitter.
+
+    Errors are sorted into classes (see classify) and each class has its
+    own limit on attempts; anything else is raised straight away.  No retry
+    starts after the deadline (seconds from creation).  When
+    breaker_threshold calls fail in a row the circuit breaker opens and
+    every call waits breaker_cooldown seconds before going out again.
+    """
+
+    def __init__(self, attempts=RETRY_ATTEMPTS, limits=None,
+                 base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 deadline=None, breaker_threshold=BREAKER_THRESHOLD,
+                 breaker_cooldown=BREAKER_COOLDOWN):
+        self.limits = {'connection': attempts, 'transfer': attempts,
+                       'server': attempts, 'io': attempts}
+        self.limits.update(limits or {})
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline and time.monotonic() + deadline
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.retries = collections.Counter()
+        self.waited = 0.0
+        self.breaker_trips = 0
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def classify(ex):
+        """Return the retry class of an exception, None if not transient"""
+        import requests
+        from cadcutils import exceptions
+        if isinstance(ex, exceptions.TransferException):
+            return 'transfer'
+        if isinstance(ex, exceptions.InternalServerException):
+            return 'server'
+        if isinstance(ex, exceptions.HttpException):
+            ex = ex.orig_exception
+        if isinstance(ex, requests.HTTPError) and ex.response is not None:
+            status = ex.response.status_code
+            return 'server' if status >= 500 or status == 429 else None
+        if isinstance(ex, (requests.ConnectionError, requests.Timeout,
+                           ConnectionError)):
+            return 'connection'
+        if getattr(ex, 'errno', None) == errno.ECONNRESET:
+            return 'connection'
+        if getattr(ex, 'errno', None) == errno.EIO:
+            return 'io'
+        return None
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+        with self._lock:
+            self.waited += seconds
+
+    def _wait_for_breaker(self):
+        while True:
+            with self._lock:
+                remaining = self._open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            self._sleep(min(remaining, 1.0))
+
+    def _record(self, failed):
+        with self._lock:
+            if not failed:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= self.breaker_threshold:
+                logging.warning("{} failures in a row, pausing for {}s".format(
+                    self._failures, self.breaker_cooldown))
+                self._failures = 0
+                self._open_until = time.monotonic() + self.breaker_cooldown
+                self.breaker_trips += 1
+
+    def call(self, func, *args, **kwargs):
+        """Call func, retrying it on transient errors"""
+        attempts = collections.Counter()
+        while True:
+            self._wait_for_breaker()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as ex:
+                error_class = self.classify(ex)
+                if error_class is None:
+                    raise
+                self._record(True)
+                attempts[error_class] += 1
+                delay = min(self.max_delay,
+                            self.base_delay * 2 ** (attempts[error_class] - 1))
+                # equal jitter: never less than half the backoff
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                if attempts[error_class] > self.limits[error_class] or \
+                        (self.deadline and time.monotonic() + delay > self.deadline):
+                    raise
+                logging.warning("{} ({} error, retry {} in {:.1f}s)".format(
+                    ex, error_class, attempts[error_class], delay))
+                with self._lock:
+                    self.retries[error_class] += 1
+                self._sleep(delay)
+            else:
+                self._record(False)
+                return result
+
+    def stats(self):
+        """One line summary of the retries done so far"""
+        return "retries: {} ({}), waited {:.1f}s, breaker opened {} times".format(
+            sum(self.retries.values()),
+            ", ".join("{} {}".format(k, v) for k, v in sorted(self.retries.items())),
+            self.waited, self.breaker_trips)
+
+
+class _RetryingClient(object):
+    """Proxy for a vos.Client that sends every method call through a
+    RetryPolicy"""
+
+    # methods that never touch the network
+    LOCAL_METHODS = ('is_remote_file', 'fix_uri', 'has_magic')
+    # methods that only read, or (copy) rewrite the whole destination, so
+    # sending them again after a transient error is safe
+    IDEMPOTENT_METHODS = ('get_node', 'get_children_info', 'glob', 'isdir',
+                          'isfile', 'access', 'open', 'get_node_url',
+                          'get_endpoints', 'copy')
+    # methods returning a generator that fetches further pages as it is
+    # read, which is retried step by step (see _retried_listing)
+    LISTING_METHODS = ('get_children_info',)
+
+    def __init__(self, client, policy):
+        self._client = client
+        self._policy = policy
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name in self.LOCAL_METHODS:
+            return attr
+
+        if name not in self.IDEMPOTENT_METHODS:
+            return self._mutation(name, attr)
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            if name in self.LISTING_METHODS:
+                return _retried_listing(self._policy, attr, *args, **kwargs)
+            return self._policy.call(attr, *args, **kwargs)
+        return call
+
+    def _mutation(self, name, attr):
+        """attr, sent once; after a transient error the nodes are checked
+        to see whether the change was made anyway (the reply was lost)"""
+        check = _MUTATION_CHECKS.get(name)
+        if check is None:
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            except Exception as ex:
+                if self._policy.classify(ex) is None:
+                    raise
+                try:
+                    done = self._policy.call(check, self._client, *args)
+                except Exception:
+                    done = False
+                if not done:
+                    raise
+                logging.info("{} {} failed ({}) but was done".format(
+                    name, ' '.join(str(arg) for arg in args), ex))
+        return call
+
+
+def _node_exists(client, uri):
+    from cadcutils import exceptions
+    try:
+        client.get_node(uri, limit=0, force=True)
+    except exceptions.NotFoundException:
+        return False
+    return True
+
+
+def _made_dir(client, uri):
+    from cadcutils import exceptions
+    try:
+        return client.get_node(uri, limit=0, force=True).isdir()
+    except exceptions.NotFoundException:
+        return False
+
+
+def _moved(client, source, destination):
+    return not _node_exists(client, source) and \
+        _node_exists(client, destination)
+
+
+# how to tell that a mutation the client sent has been made
+_MUTATION_CHECKS = {
+    'mkdir': _made_dir,
+    'delete': lambda client, uri: not _node_exists(client, uri),
+    'move': _moved,
+}
+
+
+def _retried_listing(policy, listing, *args, **kwargs):
+    """Iterate over listing(*args, **kwargs) with the call and every step
+    of the iteration sent through policy.
+
+    The pages of the listing are still fetched as it is read.  A generator
+    that raised can not be resumed, so after a transient error the listing
+    is started again and the nodes already yielded are skipped."""
+    state = {'children': policy.call(lambda: iter(listing(*args, **kwargs))),
+             'done': 0}
+
+    def next_child():
+        if state['children'] is None:
+            children = iter(listing(*args, **kwargs))
+            for _ in range(state['done']):
+                next(children)
+            state['children'] = children
+        try:
+            return next(state['children'])
+        except StopIteration:
+            raise
+        except Exception:
+            state['children'] = None
+            raise
+
+    def children():
+        while True:
+            try:
+                child = policy.call(next_child)
+            except StopIteration:
+                return
+            state['done'] += 1
+            yield child
+    return children()
+
+
+class Profiler(object):
+    """Record the latency and bytes moved of every VOSpace call and local
+    I/O helper.
+
+    Each call is kept as an event (name, thread, start, duration, bytes,
+    error) so the run can be summarised per operation or written out as a
+    Chrome trace (chrome://tracing, Perfetto, speedscope).
+    """
+
+    def __init__(self):
+        self.events = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def call(self, name, func, *args, size=None, **kwargs):
+        """Call func and record it under name, size(result, args) gives the
+        bytes moved"""
+        start = time.perf_counter()
+        error = None
+        nbytes = 0
+        try:
+            result = func(*args, **kwargs)
+            if size is not None:
+                nbytes = size(result, *args, **kwargs) or 0
+            return result
+        except Exception as ex:
+            error = type(ex).__name__
+            raise
+        finally:
+            self.record(name, start, time.perf_counter() - start, nbytes, error)
+
+    def record(self, name, start, duration, nbytes=0, error=None):
+        """Add an event that started at perf_counter() start"""
+        event = (name, threading.current_thread().name, start - self._start,
+                 duration, nbytes, error)
+        with self._lock:
+            self.events.append(event)
+
+    def listing(self, name, children):
+        """Iterate over children, recording the time spent fetching them
+        (not the time the caller spends between nodes) as one event"""
+        start = None
+        duration = 0.0
+        error = None
+        children = iter(children)
+        try:
+            while True:
+                step = time.perf_counter()
+                if start is None:
+                    start = step
+                try:
+                    child = next(children)
+                except StopIteration:
+                    return
+                finally:
+                    duration += time.perf_counter() - step
+                yield child
+        except Exception as ex:
+            error = type(ex).__name__
+            raise
+        finally:
+            if start is not None:
+                self.record(name, start, duration, error=error)
+
+    @staticmethod
+    def _percentile(durations, percent):
+        # nearest rank on a sorted list
+        return durations[max(0, int(math.ceil(percent / 100.0 * len(durations))) - 1)]
+
+    def summary(self):
+        """Table of calls, errors, bytes and p50/p95/p99 latency in ms per
+        operation, slowest total first"""
+        ops = collections.defaultdict(list)
+        with self._lock:
+            for event in self.events:
+                ops[event[0]].append(event)
+        rows = []
+        for name, events in ops.items():
+            durations = sorted(event[3] for event in events)
+            rows.append((sum(durations), name, len(events),
+                         sum(1 for event in events if event[5]),
+                         sum(event[4] for event in events), durations))
+        lines = ["{:<24} {:>7} {:>6} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+            'operation', 'calls', 'errors', 'bytes', 'total s', 'p50 ms',
+            'p95 ms', 'p99 ms')]
+        for total, name, calls, errors, nbytes, durations in sorted(rows, reverse=True):
+            lines.append("{:<24} {:>7} {:>6} {:>8} {:>9.2f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                name, calls, errors, _format_bytes(nbytes), total,
+                *[1000 * self._percentile(durations, p) for p in (50, 95, 99)]))
+        return "\n".join(lines)
+
+    def write_trace(self, filename):
+        """Write the events in Chrome trace event format"""
+        threads = {}
+        trace = []
+        with self._lock:
+            events = list(self.events)
+        for name, thread, start, duration, nbytes, error in events:
+            tid = threads.setdefault(thread, len(threads) + 1)
+            args = {'bytes': nbytes}
+            if error:
+                args['error'] = error
+            trace.append({'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                          'ts': start * 1e6, 'dur': duration * 1e6,
+                          'pid': os.getpid(), 'tid': tid, 'args': args})
+        for thread, tid in threads.items():
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                          'tid': tid, 'args': {'name': thread}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+_profiler = None
+
+
+def _timed(name, func, *args, size=None, **kwargs):
+    """Call func, recorded under name while --profile is on"""
+    if _profiler is None:
+        return func(*args, **kwargs)
+    return _profiler.call(name, func, *args, size=size, **kwargs)
+
+
+def _profiled(name, size=None):
+    """Decorator recording calls of a local helper while --profile is on"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return _timed(name, func, *args, size=size, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _copy_size(result, source, destination, *args, **kwargs):
+    """Bytes moved by a client.copy, read from its local side"""
+    for filename in (destination, source):
+        if os.path.isfile(filename):
+            return os.path.getsize(filename)
+    return 0
+
+
+class _ProfilingClient(object):
+    """Proxy for a vos.Client that records every method call in a
+    Profiler"""
+
+    SIZES = {'copy': _copy_size}
+
+    def __init__(self, client, profiler):
+        self._client = client
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name in _RetryingClient.LOCAL_METHODS:
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            result = self._profiler.call('client.' + name, attr, *args,
+                                         size=self.SIZES.get(name), **kwargs)
+            if name in _RetryingClient.LISTING_METHODS:
+                # the later pages are fetched as the listing is read
+                return self._profiler.listing('client.{}.read'.format(name),
+                                              result)
+            return result
+        return call
+
+
+_retry_policy = None
+
+
+def get_retry_policy():
+    """Return the retry policy for this invocation"""
+    global _retry_policy
+    if _retry_policy is None:
+        _retry_policy = RetryPolicy()
+    return _retry_policy
+
+
+# The canfar and vos packages are slow to import and building the client
+# reads the CANFAR config, so both are deferred until a command needs them.
+# That keeps --help, shell completion and usage errors cheap.
+_client = None
+
+
+def _vos_client():
+    """Create a vos.Client for the active CANFAR context"""
+    from canfar.context import Context
+    import vos
+    context = Context()
+    active_context = context.config.active
+    ctx = context.config.contexts[active_context]
+    token = ctx.token.access
+    return vos.Client(vospace_token=token)
+
+
+def get_client():
+    """Return the VOSpace client for the active CANFAR context, wrapped in
+    the retry policy (and the profiler with --profile)"""
+    global _client
+    if _client is None:
+        client = _vos_client()
+        if _profiler is not None:
+            # inside the retries, so every attempt is timed on its own
+            client = _ProfilingClient(client, _profiler)
+        _client = _RetryingClient(client, get_retry_policy())
+    return _client
+
+
+@app.callback()
+def main(
+    ctx: typer.Context,
+    retries: int = typer.Option(RETRY_ATTEMPTS, "--retries", min=0, help="attempts per class of transient error (connection, transfer, server, io)"),
+    retry_deadline: float = typer.Option(None, "--retry-deadline", help="do not start any retry after this many seconds"),
+    profile: bool = typer.Option(False, "--profile", help="print calls, bytes and latency percentiles of every VOSpace call and local I/O step on exit"),
+    trace: str = typer.Option(None, "--trace", help="write a Chrome trace (JSON) of every call to this file, implies --profile")
+):
+    """VOSpace commands for CANFAR."""
+    global _retry_policy, _profiler
+    _retry_policy = RetryPolicy(attempts=retries, deadline=retry_deadline)
+    if profile or trace:
+        _profiler = Profiler()
+
+    def report():
+        if _retry_policy.retries:
+            typer.echo(_retry_policy.stats(), err=True)
+        if _profiler is not None:
+            typer.echo(_profiler.summary(), err=True)
+            if trace:
+                _profiler.write_trace(trace)
+    ctx.call_on_close(report)
+
+
+# Defaults for the node metadata cache
+NODE_CACHE_SIZE = 10000
+NODE_CACHE_TTL = 60
+
+
+class NodeCache(object):
+    """Size bounded LRU cache of VOSpace nodes that expire after ttl seconds.
+
+    Nodes are keyed by the URI they were looked up with (trailing slashes
+    stripped).  The cache is shared by the worker threads of a command so
+    all access goes through a lock.
+    """
+
+    def __init__(self, max_size=NODE_CACHE_SIZE, ttl=NODE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._nodes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def get(self, uri):
+        """Return the cached node for uri or None if absent or expired"""
+        key = uri.rstrip('/')
+        with self._lock:
+            entry = self._nodes.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._nodes.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._nodes[key]
+            self.misses += 1
+            return None
+
+    def put(self, uri, node):
+        """Add node to the cache, evicting the least recently used entries"""
+        key = uri.rstrip('/')
+        with self._lock:
+            self._nodes[key] = (time.monotonic(), node)
+            self._nodes.move_to_end(key)
+            while len(self._nodes) > self.max_size:
+                self._nodes.popitem(last=False)
+
+    def invalidate(self, uri, recursive=False):
+        """Drop uri (and with recursive everything below it) from the cache"""
+        key = uri.rstrip('/')
+        with self._lock:
+            self._nodes.pop(key, None)
+            if recursive:
+                prefix = key + '/'
+                for child in [k for k in self._nodes if k.startswith(prefix)]:
+                    del self._nodes[child]
+
+    def stats(self):
+        """One line summary of the cache hit rate"""
+        return "node cache: {} hits, {} misses".format(self.hits, self.misses)
+
+
+_node_cache = None
+
+
+def get_node_cache():
+    """Return the node cache shared by the commands of this invocation"""
+    global _node_cache
+    if _node_cache is None:
+        _node_cache = NodeCache()
+    return _node_cache
+
+
+def _ordered_map(func, items, jobs):
+    """Like map() but func runs on a pool of jobs threads.
+
+    At most 2 * jobs calls are in flight at any time and the results are
+    yielded in the order of items."""
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        window = collections.deque()
+        try:
+            for item in items:
+                window.append(pool.submit(func, item))
+                if len(window) >= 2 * jobs:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+
+
+class _Progress(object):
+    """Counters shown on a single, regularly redrawn stderr line.
+
+    The line is only drawn when stderr is a terminal; the rate is that of
+    the first counter."""
+
+    def __init__(self, *names, interval=0.5):
+        self.counts = collections.OrderedDict((name, 0) for name in names)
+        self.interval = interval
+        self.start_time = time.time()
+        self._drawn = 0
+        self._lock = threading.Lock()
+        self._live = sys.stderr.isatty()
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.counts[name] += count
+            if self._live and time.time() - self._drawn > self.interval:
+                self._drawn = time.time()
+                sys.stderr.write('\r' + str(self))
+                sys.stderr.flush()
+
+    def __str__(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return "{} in {:.1f}s, {:.1f}/s".format(
+            ", ".join("{} {}".format(name, count)
+                      for name, count in self.counts.items()),
+            elapsed, next(iter(self.counts.values())) / elapsed)
+
+    def finish(self):
+        """Replace the live line with the final counts"""
+        if self._live:
+            sys.stderr.write('\r\033[K')
+        typer.echo(str(self), err=True)
+
+
+def _delete_tree(client, uris, jobs, progress):
+    """Delete the trees under uris on a pool of jobs threads.
+
+    The trees are walked (see _walk_tree) while the data and link nodes
+    found are deleted, then the containers are deleted one level at a time
+    from the deepest up.  Containers that could not be listed, or hold a
+    node that failed, are left alone.
+    Returns a list of (uri, reason) for the nodes that were not deleted.
+    """
+    failed = []
+    lock = threading.Lock()
+    levels = collections.defaultdict(list)
+
+    def delete(uri):
+        try:
+            client.delete(uri)
+            progress.add('deleted')
+        except Exception as ex:
+            logging.debug("delete {}: {}".format(uri, ex))
+            with lock:
+                failed.append((uri, str(ex)))
+            progress.add('failed')
+
+    def files():
+        """The nodes to delete before any container, found as the trees
+        are walked"""
+        containers = []
+        for uri in uris:
+            # a link to a container is deleted, not its target's contents
+            if client.get_node(uri, limit=0).isdir():
+                containers.append(uri)
+            else:
+                yield uri
+        for uri, depth, children in _walk_tree(client, containers, jobs):
+            if isinstance(children, Exception):
+                with lock:
+                    failed.append((uri, str(children)))
+                progress.add('failed')
+                continue
+            levels[depth].append(uri)
+            for child in children:
+                if not child.isdir():
+                    yield '{}/{}'.format(uri, child.name)
+
+    for _ in _ordered_map(delete, files(), jobs):
+        pass
+    for depth in sorted(levels, reverse=True):
+        blocked = set()
+        for uri, _ in failed:
+            while os.path.dirname(uri) not in blocked and '/' in uri:
+                uri = os.path.dirname(uri)
+                blocked.add(uri)
+        level = []
+        for uri in levels[depth]:
+            if uri in blocked:
+                failed.append((uri, "not empty"))
+                progress.add('failed')
+            else:
+                level.append(uri)
+        for _ in _ordered_map(delete, level, jobs):
+            pass
+    return failed
+
+
+def _walk_tree(client, uris, jobs, descend=None):
+    """Walk the container trees under uris breadth first.
+
+    Listings are requested on a pool of jobs threads with at most jobs
+    in flight, and (uri, depth, children) is yielded as each one returns,
+    children being the child Nodes or the exception the listing raised.
+    A child container is only listed if descend(uri, depth, node) is true.
+    Links are not followed.
+    """
+    def list_children(uri):
+        try:
+            return list(client.get_children_info(uri, force=True))
+        except Exception as ex:
+            logging.debug("listing {}: {}".format(uri, ex))
+            return ex
+
+    queue = collections.deque((uri.rstrip('/'), 0) for uri in uris)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        while queue or running:
+            while queue and len(running) < jobs:
+                uri, depth = queue.popleft()
+                running[pool.submit(list_children, uri)] = (uri, depth)
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                uri, depth = running.pop(future)
+                children = future.result()
+                if not isinstance(children, Exception):
+                    for child in children:
+                        child_uri = '{}/{}'.format(uri, child.name)
+                        if child.isdir() and (descend is None or descend(
+                                child_uri, depth + 1, child)):
+                            queue.append((child_uri, depth + 1))
+                yield uri, depth, children
+
+
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'cvos')
+CHECKSUM_INDEX = os.path.join(CACHE_DIR, 'md5index.sqlite')
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+@_profiled('local.download_range', size=lambda written, *args, **kwargs: written)
+def _download_range(client, uri, filename, start, end=None, partial_only=False,
+                    to_offset=None):
+    """Write bytes start to end (inclusive, None for the end of the file) of
+    the data node uri into the local filename at the same offset, or at
+    to_offset if given.
+
+    If the service ignores the range and sends the whole file, it is
+    written from the beginning instead, or with partial_only an OSError
+    is raised.  Returns the number of bytes written."""
+    # a whole file is fetched without a Range, which an empty file would
+    # answer with 416
+    byte_range = None if start == 0 and end is None else \
+        'bytes={}-{}'.format(start, '' if end is None else end)
+    response = client.open(uri, view='data', byte_range=byte_range).read(
+        return_response=True)
+    if response.status_code != 206:
+        if partial_only:
+            response.close()
+            raise OSError(errno.ENOTSUP,
+                          "{}: byte ranges not supported".format(uri))
+        start = 0
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o644)
+    offset = start if to_offset is None else to_offset
+    first = offset
+    try:
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+    finally:
+        os.close(fd)
+        response.close()
+    return offset - first
+
+
+def _resume_download(client, source, destination, size, md5=None):
+    """Download source into destination.part, carrying on from the end of
+    a .part file left by an earlier run, and rename it once complete.
+
+    The finished file is checked against md5 (if the node has one) and
+    its MD5 is returned."""
+    part = destination + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > size:
+        os.remove(part)
+        offset = 0
+    if offset:
+        logging.info("{}: resuming at byte {}".format(destination, offset))
+    if size == 0:
+        open(part, 'wb').close()
+    elif offset < size:
+        _download_range(client, source, part, offset)
+    if os.path.getsize(part) != size:
+        raise OSError(errno.EIO, "incomplete download of {} ({} of {} "
+                      "bytes)".format(source, os.path.getsize(part), size))
+    downloaded = _compute_md5(part)
+    if md5 is not None and downloaded != md5:
+        # the node changed between runs or the .part is damaged
+        os.remove(part)
+        raise OSError(errno.EIO, "MD5 of {} does not match {}".format(
+            destination, source))
+    os.replace(part, destination)
+    return downloaded
+
+
+# files from this size up are split over the --streams connections
+STREAM_THRESHOLD = '1G'
+# smallest range fetched by one request of a multi-stream download
+STREAM_PART_SIZE = 64 * 1024 * 1024
+
+
+def _parse_size(size):
+    """Convert a size such as 1024, 512K or 1.5G to a number of bytes"""
+    size = str(size).strip().upper()
+    size_unit = ['B', 'K', 'M', 'G', 'T', 'P']
+    if size and size[-1] in size_unit:
+        return int(float(size[:-1]) * 1024 ** size_unit.index(size[-1]))
+    return int(size)
+
+
+def _remove_files(*filenames):
+    """Delete the files that exist of filenames"""
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def _multi_stream_download(client, source, destination, size, md5, streams):
+    """Download source with streams concurrent ranged requests.
+
+    The ranges are written straight into a preallocated destination.streams
+    and each finished range is appended to destination.streams.ranges, so
+    a download that is interrupted only fetches the missing ranges when it
+    is run again.  The file is checked against md5 (if the node has one)
+    before being renamed to destination and its MD5 is returned.  If the
+    service ignores byte ranges an OSError with errno ENOTSUP is raised
+    and nothing is kept."""
+    part = destination + '.streams'
+    ranges_file = part + '.ranges'
+    part_size = max(1, min(STREAM_PART_SIZE,
+                           int(math.ceil(size / float(streams)))))
+    ranges = [(start, min(start + part_size, size) - 1)
+              for start in range(0, size, part_size)]
+
+    # the ranges done by an earlier run only count if they were taken
+    # from the same version of the node
+    header = {'source': source, 'size': size, 'md5': md5}
+    done = set()
+    if os.path.exists(ranges_file) and os.path.exists(part) and \
+            os.path.getsize(part) == size:
+        with open(ranges_file) as f:
+            lines = f.read().splitlines()
+        try:
+            if lines and json.loads(lines[0]) == header:
+                for line in lines[1:]:
+                    done.add(tuple(json.loads(line)))
+        except ValueError:
+            # last line of a run that was killed mid write
+            pass
+    todo = [byte_range for byte_range in ranges if byte_range not in done]
+    if len(todo) < len(ranges):
+        logging.info("{}: resuming, {} of {} ranges left".format(
+            destination, len(todo), len(ranges)))
+    else:
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        with open(ranges_file, 'w') as f:
+            f.write(json.dumps(header) + '\n')
+    logging.info("{}: {} ranges over {} streams".format(
+        source, len(todo), streams))
+
+    lock = threading.Lock()
+    with open(ranges_file, 'a') as record:
+        def fetch(byte_range):
+            written = get_retry_policy().call(
+                _download_range, client, source, part, byte_range[0],
+                byte_range[1], partial_only=True)
+            if written != byte_range[1] - byte_range[0] + 1:
+                raise OSError(errno.EIO, "short read of bytes {}-{} of "
+                              "{}".format(byte_range[0], byte_range[1], source))
+            with lock:
+                record.write(json.dumps(byte_range) + '\n')
+                record.flush()
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=streams) \
+                    as pool:
+                for _ in pool.map(fetch, todo):
+                    pass
+        except OSError as ex:
+            if ex.errno == errno.ENOTSUP:
+                _remove_files(part, ranges_file)
+            raise
+
+    downloaded = _compute_md5(part)
+    if md5 is not None and downloaded != md5:
+        # no way to tell which range is bad, start again next time
+        _remove_files(part, ranges_file)
+        raise OSError(errno.EIO, "MD5 of {} does not match {}".format(
+            destination, source))
+    os.replace(part, destination)
+    os.remove(ranges_file)
+    return downloaded
+
+
+# server side copy jobs kept running at once by a VOSpace to VOSpace cp
+REMOTE_COPY_JOBS = 16
+# first and longest wait between polls of the outstanding copy jobs
+REMOTE_COPY_POLL = 0.5
+REMOTE_COPY_MAX_POLL = 8.0
+
+
+class _UploadBody(object):
+    """Request body streaming chunks of a known total size, so the upload
+    is sent with Content-Length rather than chunked"""
+
+    def __init__(self, chunks, size):
+        self.chunks = chunks
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+
+def _put_stream(client, destination, chunks, size):
+    """Upload size bytes from the iterable chunks to the VOSpace node
+    destination"""
+    put_url = client.get_node_url(destination, method='PUT',
+                                  full_negotiation=True)[0]
+    upload = _timed(
+        'http.put', client.get_session(destination).put,
+        put_url, data=_UploadBody(chunks, size) if size else b'',
+        headers={'Content-Type': 'application/octet-stream'},
+        size=lambda response, *args, **kwargs: size)
+    upload.raise_for_status()
+
+
+def _stream_copy(client, source, destination, size, md5=None):
+    """Copy the VOSpace node source to destination by piping its download
+    straight into the upload, nothing is written locally"""
+    response = _timed('http.read', client.open(source, view='data').read,
+                      return_response=True)
+    try:
+        _put_stream(client, destination,
+                    response.iter_content(DOWNLOAD_CHUNK_SIZE), size)
+    finally:
+        response.close()
+    if md5 is not None:
+        copied = client.get_node(destination, force=True).props.get('MD5')
+        if copied is not None and copied != md5:
+            raise OSError(errno.EIO, "MD5 of {} does not match {}".format(
+                destination, source))
+    return size
+
+
+class RemoteCopyJobs(object):
+    """Server side copies between nodes of one VOSpace service.
+
+    Each copy is a transfer job with keepBytes true (copyNode), so the
+    data never comes through this host.  Up to max_jobs jobs run at once
+    and are polled together.  on_done(source, destination, error) is
+    called as each job ends.  Copies to another service, and every copy
+    after the service turns a job down, go to fallback(source,
+    destination) instead.
+    """
+
+    # job refused because the service does not do copyNode, any other
+    # refusal (e.g. 400 for a bad name) only fails that copy
+    UNSUPPORTED = (405, 501)
+
+    def __init__(self, client, max_jobs, on_done, fallback):
+        self.client = client
+        self.max_jobs = max_jobs
+        self.on_done = on_done
+        self.fallback = fallback
+        self.supported = True
+        # job URL -> (source, destination)
+        self.jobs = {}
+        self._delay = REMOTE_COPY_POLL
+
+    @staticmethod
+    def _not_supported(message):
+        """Check for the fault of a service without copyNode"""
+        return re.search(r'(copy ?node|keep ?bytes).*not supported',
+                         message or '', re.I) is not None
+
+    def _refused(self, response):
+        """Check if response turns copy jobs down for good"""
+        return response.status_code in self.UNSUPPORTED or (
+            response.status_code >= 400 and self._not_supported(response.text))
+
+    def _start(self, source, destination):
+        """Create and run a copy job, returns its URL or None if the
+        service does not accept it"""
+        from xml.etree import ElementTree
+        from cadcutils import exceptions
+        from cadcutils.net import Transfer
+        transfer_xml = ElementTree.Element("vos:transfer")
+        transfer_xml.attrib['xmlns:vos'] = Transfer.VOSNS
+        transfer_xml.attrib['version'] = Transfer.VOSVERSION
+        ElementTree.SubElement(transfer_xml, "vos:target").text = source
+        ElementTree.SubElement(transfer_xml, "vos:direction").text = destination
+        ElementTree.SubElement(transfer_xml, "vos:keepBytes").text = "true"
+        session = self.client.get_session(source)
+        try:
+            response = _timed(
+                'http.post', session.post,
+                self.client.get_endpoints(source).async_transfer,
+                data=ElementTree.tostring(transfer_xml), allow_redirects=False,
+                headers={'Content-Type': 'text/xml'})
+        except exceptions.HttpException as ex:
+            # the cadcutils session raises for an error status, a refusal
+            # is answered here rather than by the retry policy
+            response = getattr(ex.orig_exception, 'response', None)
+            if response is None or not self._refused(response):
+                raise
+        if self._refused(response):
+            logging.debug("copy job refused: {}".format(response.text))
+            return None
+        response.raise_for_status()
+        job_url = response.headers['Location']
+        _timed('http.post', session.post, job_url + '/phase', data='PHASE=RUN',
+               allow_redirects=False,
+               headers={'Content-type': 'application/x-www-form-urlencoded'}
+               ).raise_for_status()
+        return job_url
+
+    def _phase(self, job_url, source):
+        response = _timed('http.get', self.client.get_session(source).get,
+                          job_url + '/phase')
+        response.raise_for_status()
+        return response.text.strip()
+
+    def submit(self, source, destination):
+        """Start copying source to destination, waiting for a free slot"""
+        if self.supported and urlparse(self.client.fix_uri(source)).netloc == \
+                urlparse(self.client.fix_uri(destination)).netloc:
+            self.wait(self.max_jobs - 1)
+            try:
+                # the POST creates a job, so it is not sent again
+                job_url = self._start(self.client.fix_uri(source),
+                                      self.client.fix_uri(destination))
+            except Exception as ex:
+                self.on_done(source, destination, ex)
+                return
+            if job_url is not None:
+                logging.info("{} -> {} ({})".format(source, destination, job_url))
+                self.jobs[job_url] = (source, destination)
+                return
+            logging.warning("server side copy not available, streaming "
+                            "copies through this host instead")
+            self.supported = False
+        self.fallback(source, destination)
+
+    def poll(self):
+        """Check every outstanding job once, returns how many ended"""
+        ended = 0
+        for job_url, (source, destination) in list(self.jobs.items()):
+            phase = get_retry_policy().call(self._phase, job_url, source)
+            if phase in ('PENDING', 'QUEUED', 'EXECUTING', 'UNKNOWN'):
+                continue
+            del self.jobs[job_url]
+            ended += 1
+            if phase == 'COMPLETED':
+                self.on_done(source, destination, None)
+                continue
+            try:
+                # raises the error reported by the job
+                self.client.get_transfer_error(job_url, source)
+                error = OSError(errno.EIO, "copy job {} ended {}".format(
+                    job_url, phase))
+            except Exception as ex:
+                error = ex
+            if self._not_supported(str(error)):
+                self.supported = False
+                self.fallback(source, destination)
+            else:
+                self.on_done(source, destination, error)
+        return ended
+
+    def wait(self, limit=0):
+        """Poll until at most limit jobs are outstanding"""
+        while len(self.jobs) > limit:
+            if self.poll():
+                self._delay = REMOTE_COPY_POLL
+            elif len(self.jobs) > limit:
+                time.sleep(self._delay)
+                self._delay = min(2 * self._delay, REMOTE_COPY_MAX_POLL)
+
+
+# files below this size are packed into tar archives by cp --bundle
+BUNDLE_THRESHOLD = '1M'
+# data in each archive before a new one is started
+BUNDLE_SIZE = '1G'
+BUNDLE_PATTERN = re.compile(r'^cvos-bundle-.*\.tar$')
+BUNDLE_INDEX = '.index.json'
+
+
+class TarBundle(object):
+    """A tar archive of small local files streamed straight to a VOSpace
+    node.
+
+    The headers are built as files are added, so the archive size is
+    known before the upload starts and no archive is written locally.
+    Member names are relative to the directory the archive goes into.
+    The upload is followed by an index sidecar (archive name +
+    BUNDLE_INDEX) with the offset, size and MD5 of every member, which
+    lets members be fetched on their own with ranged reads.
+    """
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.members = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, filename, name):
+        import tarfile
+        st = os.stat(filename)
+        info = tarfile.TarInfo(name)
+        info.size = st.st_size
+        info.mtime = st.st_mtime
+        info.mode = st.st_mode & 0o777
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        self.members.append({'name': name, 'filename': filename,
+                             'header': header, 'offset': self.size + len(header),
+                             'size': st.st_size, 'mtime': st.st_mtime})
+        self.size += len(header) + st.st_size + (-st.st_size % 512)
+
+    def _chunks(self):
+        buffer = bytearray()
+        for member in self.members:
+            buffer += member['header']
+            md5 = hashlib.md5()
+            remaining = member['size']
+            with open(member['filename'], 'rb') as f:
+                while remaining:
+                    data = _timed('tar.read', f.read,
+                                  min(remaining, DOWNLOAD_CHUNK_SIZE),
+                                  size=lambda data, *args: len(data))
+                    if not data:
+                        raise OSError(errno.EIO, "{} shrank while being "
+                                      "bundled".format(member['filename']))
+                    md5.update(data)
+                    buffer += data
+                    remaining -= len(data)
+                    # small members are sent together
+                    if len(buffer) >= DOWNLOAD_CHUNK_SIZE:
+                        yield bytes(buffer)
+                        buffer.clear()
+            member['md5'] = md5.hexdigest()
+            buffer += bytes(-member['size'] % 512)
+        yield bytes(buffer) + bytes(1024)
+
+    def upload(self, client):
+        """Send the archive and then its index, returns the bytes of data
+        in the members"""
+        _put_stream(client, self.destination, self._chunks(), self.size + 1024)
+        index = {'archive': os.path.basename(self.destination),
+                 'members': [{key: member[key] for key in
+                              ('name', 'offset', 'size', 'mtime', 'md5')}
+                             for member in self.members]}
+        data = json.dumps(index).encode('utf-8')
+        _put_stream(client, self.destination + BUNDLE_INDEX, [data], len(data))
+        return sum(member['size'] for member in self.members)
+
+
+def _extract_bundle(client, uri, directory, patterns=None):
+    """Extract the members of the bundle archive uri below directory.
+
+    With patterns only the members whose names match one of the globs
+    are fetched, each with a ranged read of the archive; otherwise the
+    whole archive is streamed through tarfile.  Returns the number of
+    members and bytes extracted."""
+    import tarfile
+    if patterns:
+        response = _timed('http.read',
+                          client.open(uri + BUNDLE_INDEX, view='data').read,
+                          return_response=True)
+        try:
+            index = json.loads(b''.join(response.iter_content(DOWNLOAD_CHUNK_SIZE)))
+        finally:
+            response.close()
+        count = size = 0
+        for member in index['members']:
+            if not any(fnmatch.fnmatchcase(member['name'], p) for p in patterns):
+                continue
+            filename = os.path.join(directory, member['name'])
+            if not os.path.abspath(filename).startswith(
+                    os.path.abspath(directory) + os.sep):
+                raise OSError(errno.EINVAL, "{}: member {} is outside the "
+                              "destination".format(uri, member['name']))
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb'):
+                pass
+            if member['size']:
+                get_retry_policy().call(
+                    _download_range, client, uri, filename, member['offset'],
+                    member['offset'] + member['size'] - 1, partial_only=True,
+                    to_offset=0)
+            if _compute_md5(filename) != member['md5']:
+                raise OSError(errno.EIO, "MD5 of {} does not match the index "
+                              "of {}".format(filename, uri))
+            os.utime(filename, (member['mtime'], member['mtime']))
+            count += 1
+            size += member['size']
+        return count, size
+
+    def extract_all(response):
+        response.raw.decode_content = True
+        count = size = 0
+        with tarfile.open(fileobj=response.raw, mode='r|') as archive:
+            for member in archive:
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extract(member, directory, filter='data')
+                else:
+                    archive.extract(member, directory)
+                count += 1
+                size += member.size
+        return count, size
+
+    response = _timed('http.read', client.open(uri, view='data').read,
+                      return_response=True)
+    try:
+        # the archive is read from the network as it is extracted
+        return _timed('tar.extract', extract_all, response,
+                      size=lambda result, *args: result[1])
+    finally:
+        response.close()
+
+
+class CopyJournal(object):
+    """Append-only record of the files a cp has finished.
+
+    Each line is a JSON object with the source, destination, size and MD5
+    of the copy and the mtime of its local side.  An entry counts as done
+    while the local file still has that size and mtime, so a restarted cp
+    can skip it without asking the service.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._done = {}
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a run that was killed mid write
+                        continue
+                    self._done[(entry['source'], entry['destination'])] = entry
+        self._file = open(filename, 'a')
+
+    def __len__(self):
+        return len(self._done)
+
+    def is_done(self, source, destination, local_name):
+        entry = self._done.get((source, destination))
+        if entry is None:
+            return False
+        try:
+            st = os.stat(local_name)
+        except OSError:
+            return False
+        return st.st_size == entry['size'] and st.st_mtime == entry['mtime']
+
+    def record(self, source, destination, local_name, md5):
+        st = os.stat(local_name)
+        entry = {'source': source, 'destination': destination,
+                 'size': st.st_size, 'md5': md5, 'mtime': st.st_mtime}
+        with self._lock:
+            self._done[(source, destination)] = entry
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+@_profiled('local.md5', size=lambda md5, filename: os.path.getsize(filename))
+def _compute_md5(filename):
+    """MD5 of a local file, mapped into memory where possible"""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # hashlib releases the GIL while digesting large buffers
+                # so several files hash in parallel from threads
+                md5.update(data)
+        except (ValueError, OSError):
+            # empty files and special files can not be mapped
+            for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+class ChecksumIndex(object):
+    """On disk index of local file MD5s.
+
+    Entries are keyed by the absolute path and are only used while the
+    inode, size and modification time of the file are unchanged.  If the
+    index can not be created (e.g. read-only home) it is kept in memory.
+    """
+
+    def __init__(self, filename=CHECKSUM_INDEX):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            self._db = sqlite3.connect(filename, check_same_thread=False)
+        except (OSError, sqlite3.Error) as ex:
+            logging.warning("checksum index {}: {}".format(filename, ex))
+            self._db = sqlite3.connect(':memory:', check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS md5 (path TEXT PRIMARY KEY, '
+                'inode INTEGER, size INTEGER, mtime INTEGER, md5 TEXT)')
+
+    @staticmethod
+    def _stat(filename):
+        st = os.stat(filename)
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    @_profiled('sqlite.md5_lookup')
+    def lookup(self, filename):
+        """Return the indexed MD5 of filename or None if missing or stale"""
+        filename = os.path.abspath(filename)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT inode, size, mtime, md5 FROM md5 WHERE path = ?',
+                (filename,)).fetchone()
+        if row is not None and tuple(row[:3]) == self._stat(filename):
+            self.hits += 1
+            return row[3]
+        self.misses += 1
+        return None
+
+    @_profiled('sqlite.md5_store')
+    def _store(self, rows):
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO md5 VALUES (?, ?, ?, ?, ?)', rows)
+
+    def _hash(self, filename):
+        filename = os.path.abspath(filename)
+        stat = self._stat(filename)
+        return (filename,) + stat + (_compute_md5(filename),)
+
+    def md5(self, filename):
+        """Return the MD5 of filename, computing and indexing it if needed"""
+        md5 = self.lookup(filename)
+        if md5 is None:
+            row = self._hash(filename)
+            self._store([row])
+            md5 = row[-1]
+        return md5
+
+    def md5_many(self, filenames, jobs=1):
+        """Return {filename: MD5}, hashing the index misses concurrently"""
+        result = {}
+        missing = []
+        for filename in filenames:
+            md5 = self.lookup(filename)
+            if md5 is None:
+                missing.append(filename)
+            else:
+                result[filename] = md5
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                rows = list(pool.map(self._hash, missing))
+            self._store(rows)
+            for filename, row in zip(missing, rows):
+                result[filename] = row[-1]
+        return result
+
+    def prune(self):
+        """Drop entries for files that were deleted or changed since they
+        were indexed, returns the number of entries dropped"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT path, inode, size, mtime FROM md5').fetchall()
+        stale = []
+        for row in rows:
+            try:
+                if self._stat(row[0]) != tuple(row[1:]):
+                    stale.append((row[0],))
+            except OSError:
+                stale.append((row[0],))
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM md5 WHERE path = ?', stale)
+        return len(stale)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM md5').fetchone()[0]
+
+
+_checksum_index = None
+
+
+def get_checksum_index():
+    """Return the checksum index shared by the commands of this invocation"""
+    global _checksum_index
+    if _checksum_index is None:
+        _checksum_index = ChecksumIndex()
+    return _checksum_index
+
+SNAPSHOT_INDEX = os.path.join(CACHE_DIR, 'snapshot.sqlite')
+# age in seconds after which ls --cached lists the service instead
+SNAPSHOT_MAX_AGE = 3600
+
+
+def _glob_escape(text):
+    """Quote the SQLite GLOB wildcards in text"""
+    return re.sub(r'([*?\[])', r'[\1]', text)
+
+
+class SnapshotIndex(object):
+    """On disk snapshot of the nodes of chosen VOSpace trees.
+
+    refresh lists a root with _walk_tree and stores every node (type,
+    properties and link target) under its full URI.  Containers are only
+    listed again when their date changed or their last listing did not
+    finish, the rows below unchanged containers are kept.
+    """
+
+    def __init__(self, filename=SNAPSHOT_INDEX):
+        self.filename = filename
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS nodes (uri TEXT PRIMARY KEY, '
+                'parent TEXT, depth INTEGER, type TEXT, date TEXT, '
+                'props TEXT, target TEXT, listed INTEGER)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS roots (uri TEXT PRIMARY KEY, '
+                'refreshed REAL)')
+
+    @staticmethod
+    def _node(row):
+        from vos.vos import Node
+        uri, node_type, props, target = row
+        node = Node(uri, node_type=node_type, properties=json.loads(props))
+        node.target = target
+        return node
+
+    def _store(self, uri, node, keep_listing=False):
+        listed = 'CASE WHEN nodes.date IS excluded.date AND nodes.type = ' \
+            'excluded.type THEN nodes.listed ELSE 0 END' if keep_listing else '0'
+        self._db.execute(
+            'INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, 0) '
+            'ON CONFLICT(uri) DO UPDATE SET type = excluded.type, '
+            'date = excluded.date, props = excluded.props, '
+            'target = excluded.target, listed = ' + listed,
+            (uri, os.path.dirname(uri), uri.count('/'), node.type,
+             node.props.get('date'), json.dumps(node.props), node.target))
+        if not node.isdir():
+            self._db.execute('DELETE FROM nodes WHERE uri GLOB ?',
+                             (_glob_escape(uri) + '/*',))
+
+    @_profiled('sqlite.snapshot_lookup')
+    def _needs_listing(self, uri, node):
+        with self._lock:
+            row = self._db.execute('SELECT date, listed FROM nodes WHERE uri = ?',
+                                   (uri,)).fetchone()
+        return row is None or not row[1] or row[0] != node.props.get('date')
+
+    @_profiled('sqlite.snapshot_store')
+    def _store_listing(self, uri, children):
+        names = set(child.name for child in children)
+        with self._lock, self._db:
+            for (child_uri,) in self._db.execute(
+                    'SELECT uri FROM nodes WHERE parent = ?', (uri,)).fetchall():
+                if child_uri.rsplit('/', 1)[-1] not in names:
+                    self._db.execute('DELETE FROM nodes WHERE uri = ? OR uri GLOB ?',
+                                     (child_uri, _glob_escape(child_uri) + '/*'))
+            for child in children:
+                self._store('{}/{}'.format(uri, child.name), child,
+                            keep_listing=True)
+            self._db.execute('UPDATE nodes SET listed = 1 WHERE uri = ?', (uri,))
+
+    def refresh(self, client, root, jobs, progress, full=False):
+        """Bring the snapshot of the tree at root up to date, returns the
+        containers that could not be listed"""
+        start_time = time.time()
+        root = client.fix_uri(root).rstrip('/')
+        root_node = client.get_node(root, limit=0, force=True)
+        with self._lock, self._db:
+            self._store(root, root_node, keep_listing=True)
+
+        def descend(uri, depth, child):
+            if full or self._needs_listing(uri, child):
+                return True
+            progress.add('unchanged')
+            return False
+
+        failed = []
+        if root_node.isdir():
+            for uri, depth, children in _walk_tree(client, [root], jobs, descend):
+                if isinstance(children, Exception):
+                    failed.append(uri)
+                    progress.add('failed')
+                    logging.error("{}: {}".format(uri, children))
+                    continue
+                self._store_listing(uri, children)
+                progress.add('listed')
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO roots VALUES (?, ?)',
+                             (root, start_time))
+        return failed
+
+    def roots(self):
+        """[(root, refreshed, nodes)]"""
+        with self._lock:
+            roots = self._db.execute('SELECT uri, refreshed FROM roots '
+                                     'ORDER BY uri').fetchall()
+            return [(root, refreshed, self._db.execute(
+                'SELECT COUNT(*) FROM nodes WHERE uri = ? OR uri GLOB ?',
+                (root, _glob_escape(root) + '/*')).fetchone()[0])
+                for root, refreshed in roots]
+
+    def root_for(self, uri):
+        """The indexed root holding uri and when it was refreshed, or
+        (None, None)"""
+        uri = uri.rstrip('/')
+        for root, refreshed, _ in sorted(self.roots(), key=lambda r: -len(r[0])):
+            if uri == root or uri.startswith(root + '/'):
+                return root, refreshed
+        return None, None
+
+    def drop(self, root):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM roots WHERE uri = ?', (root,))
+            self._db.execute('DELETE FROM nodes WHERE uri = ? OR uri GLOB ?',
+                             (root, _glob_escape(root) + '/*'))
+
+    @_profiled('sqlite.snapshot_lookup')
+    def get_node(self, uri):
+        with self._lock:
+            row = self._db.execute('SELECT uri, type, props, target FROM nodes '
+                                   'WHERE uri = ?', (uri.rstrip('/'),)).fetchone()
+        return None if row is None else self._node(row)
+
+    @_profiled('sqlite.snapshot_lookup')
+    def children(self, uri):
+        with self._lock:
+            rows = self._db.execute('SELECT uri, type, props, target FROM nodes '
+                                    'WHERE parent = ? ORDER BY uri',
+                                    (uri.rstrip('/'),)).fetchall()
+        return [self._node(row) for row in rows]
+
+    @_profiled('sqlite.snapshot_lookup')
+    def glob(self, pattern):
+        pattern = pattern.rstrip('/')
+        if not glob.has_magic(pattern):
+            return [pattern] if self.get_node(pattern) is not None else []
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT uri FROM nodes WHERE uri GLOB ? AND depth = ? ORDER BY uri',
+                (pattern.replace('[!', '[^'), pattern.count('/')))]
+
+
+class _SnapshotClient(object):
+    """Proxy for a vos.Client answering glob, get_node and
+    get_children_info from a SnapshotIndex for nodes below root"""
+
+    def __init__(self, client, index, root):
+        self._client = client
+        self._index = index
+        self._root = root
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _indexed(self, uri):
+        uri = self._client.fix_uri(uri).rstrip('/')
+        if uri == self._root or uri.startswith(self._root + '/'):
+            return uri
+        return None
+
+    def glob(self, pathname):
+        uri = self._indexed(pathname)
+        if uri is None:
+            return self._client.glob(pathname)
+        return self._index.glob(uri)
+
+    def get_node(self, uri, limit=None, force=False):
+        indexed = self._indexed(uri)
+        if indexed is None:
+            # e.g. the target of a link out of the indexed tree
+            return self._client.get_node(uri, limit=limit, force=force)
+        node = self._index.get_node(indexed)
+        if node is None:
+            raise OSError(errno.ENOENT, "{} not found in the snapshot "
+                          "index".format(uri))
+        return node
+
+    def get_children_info(self, uri, sort=None, order=None, force=False):
+        indexed = self._indexed(uri)
+        if indexed is None:
+            return self._client.get_children_info(uri, sort, order)
+        node = self.get_node(indexed)
+        if not node.isdir():
+            return [node]
+        children = self._index.children(indexed)
+        if sort is not None or order is not None:
+            children.sort(key=lambda node: _get_sort_key(node, sort),
+                          reverse=order == 'desc')
+        return children
 
-app = typer.Typer()
 
 # Global flag for human-readable sizes
 human_readable = False
@@ -46,6 +1661,23 @@ def size_format(size):
     return "%12s " % length
 
 
+def group_format(value):
+    """Format a read/write group without the CADC GMS prefix"""
+    from vos.vos import CADC_GMS_PREFIX
+    return " {:<15}".format(value.replace(CADC_GMS_PREFIX, ""))
+
+
+def _format_bytes(size):
+    """Format a byte count with a binary unit suffix, e.g. 3.2G"""
+    size_unit = ['B', 'K', 'M', 'G', 'T', 'P']
+    scale = 0
+    size = float(size)
+    while size >= 1024 and scale < len(size_unit) - 1:
+        size /= 1024.0
+        scale += 1
+    return "%.1f%s" % (size, size_unit[scale])
+
+
 def date_format(epoch):
     """given an epoch, return a unix-ls like formatted string"""
     time_tuple = time.localtime(epoch)
@@ -56,10 +1688,8 @@ def date_format(epoch):
 
 __LIST_FORMATS__ = {'permissions': lambda value: "{:<11}".format(value),
                     'creator': lambda value: " {:<20}".format(value),
-                    'readGroup': lambda value: " {:<15}".format(
-                        value.replace(CADC_GMS_PREFIX, "")),
-                    'writeGroup': lambda value: " {:<15}".format(
-                        value.replace(CADC_GMS_PREFIX, "")),
+                    'readGroup': group_format,
+                    'writeGroup': group_format,
                     'isLocked': lambda value: " {:<8}".format(["", "LOCKED"][
                         value == "true"]),
                     'size': size_format,
@@ -67,6 +1697,7 @@ __LIST_FORMATS__ = {'permissions': lambda value: "{:<11}".format(value),
 
 
 def _get_sort_key(node, sort):
+    from vos.vos import SortNodeProperty, convert_vospace_time_to_seconds
     if sort == SortNodeProperty.LENGTH:
         return int(node.props['length'])
     elif sort == SortNodeProperty.DATE:
@@ -75,18 +1706,67 @@ def _get_sort_key(node, sort):
         return node.name
 
 
-def _display_target(columns, row):
+# node properties written by ls --format csv, after name, uri, type and target
+__RAW_PROPS__ = ['length', 'date', 'MD5', 'creator', 'groupread', 'groupwrite',
+                 'ispublic', 'ivo://cadc.nrc.ca/vospace/core#islocked']
+
+# number of lines ls collects before writing them out
+OUTPUT_BATCH_SIZE = 1000
+
+
+class ListFormat(str, Enum):
+    text = "text"
+    jsonl = "jsonl"
+    csv = "csv"
+
+
+class _BatchedOutput(object):
+    """Collect lines of output and write them to stdout in batches"""
+
+    def __init__(self, batch_size=OUTPUT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._lines = []
+
+    def write(self, text):
+        self._lines.append(text)
+        if len(self._lines) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            sys.stdout.write(''.join(self._lines))
+            sys.stdout.flush()
+            self._lines = []
+
+
+def _display_target(columns, row, out=None):
+    out = out or sys.stdout
     name_string = row.name
-    info = row.get_info()
+    line = []
+    # with no columns nothing from get_info is shown, skip building it
+    info = columns and row.get_info()
     for col in columns:
         value = info.get(col, None)
         value = value is not None and value or ""
         if col in __LIST_FORMATS__:
-            sys.stdout.write(__LIST_FORMATS__[col](value))
+            line.append(__LIST_FORMATS__[col](value))
         if info["permissions"][0] == 'l':
             name_string = "%s -> %s" % (
                 row.name, info['target'])
-    sys.stdout.write("%s\n" % name_string)
+    line.append("%s\n" % name_string)
+    out.write(''.join(line))
+
+
+def _display_raw(list_format, row, out):
+    """Write the unformatted properties of a node as a JSON or CSV record"""
+    if list_format == ListFormat.jsonl:
+        out.write(json.dumps({'name': row.name, 'uri': row.uri,
+                              'type': row.type, 'target': row.target,
+                              'props': row.props}) + '\n')
+    else:
+        csv.writer(out).writerow(
+            [row.name, row.uri, row.type, row.target or ''] +
+            [row.props.get(prop) or '' for prop in __RAW_PROPS__])
 
 
 @app.command()
@@ -97,9 +1777,27 @@ def ls(
     human: bool = typer.Option(False, "--human", "-h", help="make sizes human readable"),
     size_sort: bool = typer.Option(False, "--Size", "-S", help="sort files by size"),
     reverse: bool = typer.Option(False, "--reverse", "-r", help="reverse the sort order"),
-    time_sort: bool = typer.Option(False, "--time", "-t", help="sort by time copied to VOSpace")
+    time_sort: bool = typer.Option(False, "--time", "-t", help="sort by time copied to VOSpace"),
+    jobs: int = typer.Option(8, "--jobs", "-j", min=1, help="number of nodes to look up concurrently"),
+    list_format: ListFormat = typer.Option(ListFormat.text, "--format", help="text listing, or raw node properties as JSON lines or CSV"),
+    cached: bool = typer.Option(False, "--cached", help="answer from the snapshot index (see index refresh) instead of the service"),
+    max_age: float = typer.Option(SNAPSHOT_MAX_AGE, "--max-age", help="with --cached, seconds after which the snapshot is too old and the service is listed"),
+    snapshot_index: str = typer.Option(SNAPSHOT_INDEX, "--index", help="with --cached, location of the snapshot index")
 ):
     """Lists information about a VOSpace DataNode or the contents of a ContainerNode."""
+    from vos.vos import SortNodeProperty
+    client = get_client()
+    if cached:
+        index = SnapshotIndex(snapshot_index)
+        root, refreshed = index.root_for(client.fix_uri(uri))
+        if root is None:
+            logging.warning("{} is not in the snapshot index, listing the "
+                            "service".format(uri))
+        elif time.time() - refreshed > max_age:
+            logging.warning("snapshot of {} is {:.0f}s old, listing the "
+                            "service".format(root, time.time() - refreshed))
+        else:
+            client = _SnapshotClient(client, index, root)
     global human_readable
     human_readable = human
 
@@ -137,12 +1835,15 @@ def ls(
 
     targets = client.glob(uri)
 
-    # segregate files from directories
-    for target in targets:
+    def resolve(target):
         target_node = client.get_node(target)
         if not long or target.endswith('/'):
             while target_node.islink():
                 target_node = client.get_node(target_node.target)
+        return target, target_node
+
+    # segregate files from directories
+    for target, target_node in _ordered_map(resolve, targets, jobs):
         if target_node.isdir():
             dirs.append((_get_sort_key(target_node, sort),
                         target_node, target))
@@ -150,36 +1851,266 @@ def ls(
             files.append((_get_sort_key(target_node, sort),
                          target_node))
 
-    for f in sorted(files, key=lambda ff: ff[0],
-                    reverse=(order == 'desc')):
-        _display_target(columns, f[1])
-
-    for d in sorted(dirs, key=lambda dd: dd[0], reverse=(order == 'desc')):
-        n = d[1]
-        if (len(dirs) + len(files)) > 1:
-            sys.stdout.write('\n{}:\n'.format(n.name))
-            if long:
-                sys.stdout.write('total: {}\n'.format(
-                    int(n.get_info()['size'])))
-        for row in client.get_children_info(d[2], sort, order):
-            _display_target(columns, row)
+    out = _BatchedOutput()
+    if list_format == ListFormat.text:
+        def display(row):
+            _display_target(columns, row, out)
+    else:
+        def display(row):
+            _display_raw(list_format, row, out)
+        if list_format == ListFormat.csv:
+            csv.writer(out).writerow(['name', 'uri', 'nodetype', 'target'] +
+                                     [p.split('#')[-1] for p in __RAW_PROPS__])
+
+    try:
+        for f in sorted(files, key=lambda ff: ff[0],
+                        reverse=(order == 'desc')):
+            display(f[1])
+
+        dirs = sorted(dirs, key=lambda dd: dd[0], reverse=(order == 'desc'))
+        if len(dirs) > 1 and jobs > 1:
+            # fetch the next few listings while the current one is printed
+            listings = _ordered_map(
+                lambda dd: list(client.get_children_info(dd[2], sort, order)),
+                dirs, jobs)
+        else:
+            listings = (client.get_children_info(dd[2], sort, order)
+                        for dd in dirs)
+        for d, rows in zip(dirs, listings):
+            n = d[1]
+            if list_format == ListFormat.text and (len(dirs) + len(files)) > 1:
+                out.write('\n{}:\n'.format(n.name))
+                if long:
+                    out.write('total: {}\n'.format(
+                        int(n.get_info()['size'])))
+            for row in rows:
+                display(row)
+    finally:
+        out.flush()
+
+
+# pixel cutouts and extensions, e.g. file.fits[1][100:200,100:200]
+cutout_pattern = re.compile(
+    r'(.*?)(?P<cutout>(\[[\-+]?[\d*]+(:[\-+]?[\d*]+)?'
+    r'(,[\-+]?[\d*]+(:[\-+]?[\d*]+)?)?\])+)$')
+
+# circle cutouts, e.g. file.fits(10.5,-20.1,0.01)
+ra_dec_cutout_pattern = re.compile(r"(.*?)"
+                                   r"(?P<cutout>\("
+                                   r"(?P<ra>[\-+]?\d*(\.\d*)?),"
+                                   r"(?P<dec>[\-+]?\d*(\.\d*)?),"
+                                   r"(?P<rad>\d*(\.\d*)?)\))$")
+
+# cutouts fetched at once when cp is not given --jobs
+CUTOUT_JOBS = 8
+
+
+def _read_cutout_targets(filename):
+    """Read a cp --targets file into [(cutout, label)].
+
+    Each line is RA DEC RADIUS (degrees, space or comma separated) or a
+    pixel cutout such as [1][100:200,100:200], optionally followed by a
+    name for the target."""
+    targets = []
+    with open(filename) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('['):
+                words = line.split(None, 1)
+                match = cutout_pattern.search(words[0])
+                if match is None or match.group(1):
+                    raise ValueError("{}:{}: bad pixel cutout {}".format(
+                        filename, line_number, words[0]))
+                cutout = words[0]
+                label = re.sub(r'[\[\]]+', '_', cutout).strip('_')
+            else:
+                words = line.replace(',', ' ').split(None, 3)
+                try:
+                    ra, dec, rad = [float(word) for word in words[:3]]
+                except ValueError:
+                    raise ValueError("{}:{}: expected RA DEC RADIUS, got "
+                                     "{}".format(filename, line_number, line))
+                cutout = "({},{},{})".format(*words[:3])
+                label = "_".join(words[:3])
+                words = words[2:]
+            if len(words) > 1:
+                label = words[1]
+            targets.append((cutout, re.sub(r'[^\w.+-]+', '-', label).strip('-')))
+    return targets
+
+
+def _cutout_name(filename, label):
+    """filename with the target label before its extension, e.g.
+    tile.fits.fz -> tile_M31.fits.fz"""
+    match = re.match(r'(.+?)(\.fits?(\.fz|\.gz)?|\.fts)$', filename, re.I)
+    stem, extension = match.group(1, 2) if match else os.path.splitext(filename)
+    return "{}_{}{}".format(stem, label, extension)
+
+
+class PathFilter(object):
+    """Compiled --include/--exclude rules, matched against the path of a
+    node relative to the directory being copied.
+
+    Rules follow rsync: a trailing / only matches directories, a leading
+    / anchors the rule at the top of the copy, a rule with a / elsewhere
+    is matched against the whole relative path and any other rule against
+    the last component.  * and ? do not cross a /, ** does.  A rule
+    starting with re: is a regular expression searched for in the
+    relative path and a rule without wildcards matches any path that
+    contains it, as cp always did.  Excludes win over includes.
+    """
+
+    class Rule(object):
+
+        def __init__(self, pattern):
+            self.pattern = pattern
+            self.dir_only = False
+            self.anchored = False
+            self.parts = None
+            if pattern.startswith('re:'):
+                self.kind = 'regex'
+                self.regex = re.compile(pattern[3:])
+                return
+            if not glob.has_magic(pattern) and not pattern.startswith('/') \
+                    and not pattern.endswith('/'):
+                self.kind = 'substring'
+                return
+            self.kind = 'glob'
+            self.dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            self.anchored = '/' in pattern
+            pattern = pattern.lstrip('/')
+            self.parts = pattern.split('/')
+            self.regex = re.compile(self._translate(pattern) + r'\Z')
+
+        @staticmethod
+        def _translate(pattern):
+            """Glob to regular expression where only ** matches a /"""
+            result = []
+            i = 0
+            while i < len(pattern):
+                c = pattern[i]
+                if pattern.startswith('**', i):
+                    result.append('.*')
+                    i += 2
+                    continue
+                if c == '*':
+                    result.append('[^/]*')
+                elif c == '?':
+                    result.append('[^/]')
+                elif c == '[' and ']' in pattern[i + 2:]:
+                    end = pattern.index(']', i + 2)
+                    chars = pattern[i + 1:end]
+                    if chars.startswith('!'):
+                        chars = '^' + chars[1:]
+                    result.append('[' + chars.replace('\\', '\\\\') + ']')
+                    i = end
+                else:
+                    result.append(re.escape(c))
+                i += 1
+            return ''.join(result)
+
+        def matches(self, relative, is_dir):
+            if self.kind == 'regex':
+                return self.regex.search(relative) is not None
+            if self.kind == 'substring':
+                return self.pattern in relative
+            components = relative.split('/')
+            if self.dir_only and not is_dir:
+                # a file matches through the directories it is in
+                components = components[:-1]
+                candidates = ['/'.join(components[:i])
+                              for i in range(1, len(components) + 1)] \
+                    if self.anchored else components
+                return any(self.regex.match(c) for c in candidates)
+            if not self.anchored:
+                relative = components[-1]
+            return self.regex.match(relative) is not None
+
+        def may_match_below(self, relative):
+            """False only when nothing inside directory relative can match"""
+            if not self.anchored:
+                return True
+            for i, component in enumerate(relative.split('/')):
+                if i >= len(self.parts):
+                    # inside a directory the rule matched, or too deep
+                    return self.dir_only
+                if '**' in self.parts[i]:
+                    return True
+                if not fnmatch.fnmatchcase(component, self.parts[i]):
+                    return False
+            return True
+
+    def __init__(self, exclude=None, include=None):
+        self.exclude = [self.Rule(p) for p in self._split(exclude)]
+        self.include = [self.Rule(p) for p in self._split(include)]
+
+    @staticmethod
+    def _split(patterns):
+        return [p for arg in patterns or [] for p in arg.split(',') if p]
+
+    def __bool__(self):
+        return bool(self.exclude or self.include)
+
+    def skip(self, relative, is_dir):
+        """True if the node at relative should not be copied, or for a
+        directory, not be listed at all"""
+        if any(rule.matches(relative, is_dir) for rule in self.exclude):
+            return True
+        if not self.include:
+            return False
+        if is_dir:
+            return not any(rule.may_match_below(relative) for rule in self.include)
+        return not any(rule.matches(relative, is_dir) for rule in self.include)
+
         
 @app.command()
 def cp(
     source: list[str] = typer.Argument(..., help="file/directory/dataNode/containerNode to copy from"),
     destination: str = typer.Argument(..., help="file/directory/dataNode/containerNode to copy to"),
-    exclude: str = typer.Option(None, "--exclude", help="skip files that match pattern (overrides include)"),
-    include: str = typer.Option(None, "--include", help="only copy files that match pattern"),
+    exclude: list[str] = typer.Option(None, "--exclude", help="skip files and directories that match pattern (overrides include); rsync style glob, re:REGEX or substring, comma separated or repeated"),
+    include: list[str] = typer.Option(None, "--include", help="only copy files that match pattern, same syntax as --exclude"),
     interrogate: bool = typer.Option(False, "-i", "--interrogate", help="Ask before overwriting files"),
     follow_links: bool = typer.Option(False, "-L", "--follow-links", help="follow symbolic links. Default is to not follow links."),
     ignore: bool = typer.Option(False, "--ignore", help="ignore errors and continue with recursive copy"),
-    head: bool = typer.Option(False, "--head", help="copy only the headers of a file from vospace")
+    head: bool = typer.Option(False, "--head", help="copy only the headers of a file from vospace"),
+    jobs: int = typer.Option(None, "-j", "--jobs", min=1, show_default=False, help=f"number of files to transfer concurrently, by default 1 or {CUTOUT_JOBS} for cutouts"),
+    update: bool = typer.Option(False, "-u", "--update", help="only copy files whose size, date or MD5 differ from the destination"),
+    delete: bool = typer.Option(False, "--delete", help="delete destination files that are missing from the source directory"),
+    dry_run: bool = typer.Option(False, "-n", "--dry-run", help="report what would be copied or deleted without doing it"),
+    journal_file: str = typer.Option(None, "--journal", help="record finished files here and skip them when the copy is restarted; downloads resume from partial files"),
+    streams: int = typer.Option(1, "--streams", min=1, help="download files above --stream-threshold over this many concurrent connections"),
+    stream_threshold: str = typer.Option(STREAM_THRESHOLD, "--stream-threshold", help="smallest file size (e.g. 512M) to download with --streams"),
+    bundle: bool = typer.Option(False, "--bundle", help="upload files below --bundle-threshold packed into tar archives with an index; on download, extract such archives"),
+    bundle_threshold: str = typer.Option(BUNDLE_THRESHOLD, "--bundle-threshold", help="with --bundle, largest file size (e.g. 64K) to pack"),
+    bundle_size: str = typer.Option(BUNDLE_SIZE, "--bundle-size", help="with --bundle, data in each archive before another is started"),
+    member: list[str] = typer.Option(None, "--member", help="with --bundle, only extract the members matching this glob (repeatable)"),
+    targets_file: str = typer.Option(None, "--targets", help="file of cutouts to take from every source, one per line: RA DEC RADIUS [NAME] or a pixel cutout such as [1][100:200,100:200] [NAME]")
 ):
     """Copy files to and from VOSpace. Always recursive."""
+    from vos.vos import convert_vospace_time_to_seconds, ZERO_MD5
+    from cadcutils import exceptions
+    client = get_client()
+    node_cache = get_node_cache()
 
     class Nonlocal():
         # workaround for nonlocal scope
         exit_code = 0
+        files = 0
+        bytes = 0
+        unchanged = 0
+        deleted = 0
+        journaled = 0
+        pruned = 0
+        filtered = 0
+        bundles = 0
+        bundles_started = 0
+        # archive being filled by --bundle and the directory it goes in
+        bundle = None
+        bundle_root = None
+        lock = threading.Lock()
 
     dest = destination
     this_destination = dest
@@ -187,26 +2118,29 @@ def cp(
     if not client.is_remote_file(dest):
         dest = os.path.abspath(dest)
 
-    cutout_pattern = re.compile(
-        r'(.*?)(?P<cutout>(\[[\-+]?[\d*]+(:[\-+]?[\d*]+)?'
-        r'(,[\-+]?[\d*]+(:[\-+]?[\d*]+)?)?\])+)$')
-
-    ra_dec_cutout_pattern = re.compile(r"([^()]*?)"
-                                       r"(?P<cutout>\("
-                                       r"(?P<ra>[\-+]?\d*(\.\d*)?),"
-                                       r"(?P<dec>[\-+]?\d*(\.\d*)?),"
-                                       r"(?P<rad>\d*(\.\d*)?)\))?")
-
     def get_node(filename, limit=None):
         """Get node, from cache if possible"""
-        return client.get_node(filename, limit=limit)
+        node = node_cache.get(filename)
+        if node is None:
+            node = client.get_node(filename, limit=limit)
+            node_cache.put(filename, node)
+        return node
 
     def isdir(filename):
         logging.debug("Doing an isdir on %s" % filename)
         if client.is_remote_file(filename):
-            return client.isdir(filename)
+            # same as client.isdir but links are followed through the cache
+            try:
+                node = get_node(filename, limit=0)
+                while node.islink():
+                    if not client.is_remote_file(node.target):
+                        return False
+                    node = get_node(node.target, limit=0)
+                return node.isdir()
+            except exceptions.NotFoundException:
+                return False
         else:
-            return os.path.isdir(filename)
+            return _timed('local.stat', os.path.isdir, filename)
 
     def islink(filename):
         logging.debug("Doing an islink on %s" % filename)
@@ -216,7 +2150,7 @@ def cp(
             except exceptions.NotFoundException:
                 return False
         else:
-            return os.path.islink(filename)
+            return _timed('local.stat', os.path.islink, filename)
 
     def access(filename, mode):
         """Check if the file can be accessed."""
@@ -229,19 +2163,26 @@ def cp(
                     exceptions.UnauthorizedException):
                 return False
         else:
-            return os.access(filename, mode)
+            return _timed('local.stat', os.access, filename, mode)
 
     def listdir(dirname):
         """Walk through the directory structure a al os.walk"""
         logging.debug("getting a dirlist %s " % dirname)
         if client.is_remote_file(dirname):
-            return client.listdir(dirname, force=True)
+            # the listing carries the full node of every child, keep them
+            # so the recursion doesn't have to fetch each one again
+            names = []
+            for child in client.get_children_info(dirname, force=True):
+                node_cache.put(os.path.join(dirname, child.name), child)
+                names.append(child.name)
+            return names
         else:
-            return os.listdir(dirname)
+            return _timed('local.listdir', os.listdir, dirname)
 
     def mkdir(filename):
         logging.debug("Making directory %s " % filename)
         if client.is_remote_file(filename):
+            node_cache.invalidate(filename)
             return client.mkdir(filename)
         else:
             return os.mkdir(filename)
@@ -249,9 +2190,62 @@ def cp(
     def get_md5(filename):
         logging.debug("getting the MD5 for %s" % filename)
         if client.is_remote_file(filename):
-            return get_node(filename).props.get('MD5', vos.ZERO_MD5)
+            return get_node(filename).props.get('MD5', ZERO_MD5)
+        else:
+            return get_checksum_index().md5(filename)
+
+    def get_size(filename):
+        if client.is_remote_file(filename):
+            return int(get_node(filename).props.get('length', 0))
+        else:
+            return _timed('local.stat', os.path.getsize, filename)
+
+    def get_date(filename):
+        if client.is_remote_file(filename):
+            return convert_vospace_time_to_seconds(
+                get_node(filename).props['date'])
+        else:
+            return _timed('local.stat', os.path.getmtime, filename)
+
+    def has_md5(filename):
+        if client.is_remote_file(filename):
+            return 'MD5' in get_node(filename).props
+        return True
+
+    def has_cutout(filename):
+        return cutout_pattern.search(filename) is not None or \
+            ra_dec_cutout_pattern.search(filename) is not None
+
+    def is_unchanged(source_name, destination_name):
+        """Check if destination_name already holds a copy of source_name.
+
+        The sizes must match and then the MD5s, or the destination must be
+        at least as new as the source when either side has no MD5."""
+        if not access(destination_name, os.F_OK) or isdir(destination_name):
+            return False
+        if get_size(source_name) != get_size(destination_name):
+            return False
+        if has_md5(source_name) and has_md5(destination_name):
+            return get_md5(source_name) == get_md5(destination_name)
+        return get_date(destination_name) >= get_date(source_name)
+
+    def remove(filename):
+        """Delete a file or directory tree that is not in the source"""
+        logging.info("deleting %s" % filename)
+        with Nonlocal.lock:
+            Nonlocal.deleted += 1
+        if dry_run:
+            typer.echo("deleting {}".format(filename))
+        elif client.is_remote_file(filename):
+            node_cache.invalidate(filename, recursive=True)
+            if isdir(filename):
+                client.recursive_delete(filename)
+            else:
+                client.delete(filename)
+        elif os.path.isdir(filename) and not os.path.islink(filename):
+            shutil.rmtree(filename)
         else:
-            return md5_cache.MD5Cache.compute_md5(filename)
+            os.remove(filename)
 
     def lglob(pathname):
         if client.is_remote_file(pathname):
@@ -259,29 +2253,198 @@ def cp(
         else:
             return glob.glob(pathname)
 
-    def copy_file(source_name, destination_name, exclude_arg=None, include_arg=None,
+    def handle_os_error(os_exception):
+        logging.debug(str(os_exception))
+        if getattr(os_exception, 'errno', -1) == errno.EINVAL:
+            # not a valid uri, just skip those...
+            logging.warning("%s: Skipping" % str(os_exception))
+            with Nonlocal.lock:
+                Nonlocal.exit_code = errno.EINVAL
+        else:
+            typer.echo(f"Error: {os_exception}", err=True)
+            raise typer.Exit(1)
+
+    def multi_stream(source_name, destination_name):
+        """Download over --streams connections and return the MD5 of the
+        file, None if the service ignores byte ranges and the file has to
+        come over one stream"""
+        try:
+            return _multi_stream_download(
+                client, source_name, destination_name, get_size(source_name),
+                get_md5(source_name) if has_md5(source_name) else None,
+                streams)
+        except OSError as os_exception:
+            if os_exception.errno != errno.ENOTSUP:
+                raise
+            logging.warning("{}, using one stream".format(os_exception))
+            return None
+
+    def transfer(source_name, destination_name, ignore_arg=False, head_arg=False):
+        """Copy a single file.
+
+        Transient errors are retried by the client's RetryPolicy, with
+        ignore_arg any error that remains skips the file."""
+        try:
+            try:
+                logging.debug("Starting call to copy")
+                download = client.is_remote_file(source_name) and \
+                    not head_arg and not has_cutout(source_name)
+                if download and client.is_remote_file(destination_name):
+                    # a copy the service could not do itself
+                    size = get_retry_policy().call(
+                        _stream_copy, client, source_name, destination_name,
+                        get_size(source_name),
+                        get_md5(source_name) if has_md5(source_name) else None)
+                else:
+                    md5 = None
+                    if download and streams > 1 and \
+                            get_size(source_name) >= stream_threshold_bytes:
+                        md5 = multi_stream(source_name, destination_name)
+                    if md5 is not None:
+                        size = get_size(source_name)
+                    elif journal is None:
+                        size = client.copy(source_name, destination_name,
+                                           head=head_arg)
+                    elif download:
+                        md5 = get_retry_policy().call(
+                            _resume_download, client, source_name,
+                            destination_name, get_size(source_name),
+                            get_md5(source_name) if has_md5(source_name)
+                            else None)
+                        size = get_size(source_name)
+                    else:
+                        md5 = client.copy(source_name, destination_name,
+                                          send_md5=True, head=head_arg)
+                    if journal is not None:
+                        local_name = source_name \
+                            if client.is_remote_file(destination_name) \
+                            else destination_name
+                        size = os.path.getsize(local_name)
+                        journal.record(source_name, destination_name,
+                                       local_name, md5)
+                node_cache.invalidate(destination_name)
+                logging.debug("Call to copy returned")
+                with Nonlocal.lock:
+                    Nonlocal.files += 1
+                    Nonlocal.bytes += size or 0
+            except Exception as client_exception:
+                logging.debug("{}".format(client_exception))
+                if not ignore_arg:
+                    raise client_exception
+                logging.error("%s (skipping)" % str(client_exception))
+                with Nonlocal.lock:
+                    Nonlocal.exit_code = \
+                        getattr(client_exception, 'errno', None) or 1
+        except OSError as os_exception:
+            handle_os_error(os_exception)
+
+    def wait_pending(limit):
+        """Wait until at most limit transfers are outstanding, re-raising
+        the first failure."""
+        while len(pending) > limit:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                future.result()
+
+    def copy_file(source_name, destination_name, relative_name='',
              interrogate_arg=False, overwrite=False, ignore_arg=False, head_arg=False):
         """
         Send source_name to destination, possibly looping over contents if
-        source_name points to a directory.
+        source_name points to a directory.  relative_name is the path of
+        source_name below the source given on the command line, which the
+        --include/--exclude rules are matched against.
         """
         try:
-            if not follow_links and islink(source_name):
+            # a cutout can only be of a file and the service reports one
+            # that is missing, so it costs no lookups here
+            cutout_source = client.is_remote_file(source_name) and \
+                has_cutout(source_name)
+            if not cutout_source and not follow_links and islink(source_name):
                 logging.info("{}: Skipping (symbolic link)".format(source_name))
                 return
-            if isdir(source_name):
+            source_is_dir = not cutout_source and isdir(source_name)
+            if relative_name and path_filter.skip(relative_name, source_is_dir):
+                # for a directory this happens before it is listed, so an
+                # excluded subtree costs one lookup
+                logging.debug("{}: filtered".format(source_name))
+                with Nonlocal.lock:
+                    if source_is_dir:
+                        Nonlocal.pruned += 1
+                    else:
+                        Nonlocal.filtered += 1
+                return
+            if source_is_dir:
                 # make sure the destination exists...
+                destination_names = []
                 if not isdir(destination_name):
-                    mkdir(destination_name)
+                    if dry_run:
+                        typer.echo("creating {}".format(destination_name))
+                    else:
+                        mkdir(destination_name)
+                elif update or delete:
+                    # one listing fills the node cache for all the
+                    # comparisons against the destination
+                    destination_names = listdir(destination_name)
                 # for all files in the current source directory copy them to
                 # the destination directory
-                for filename in listdir(source_name):
+                source_names = listdir(source_name)
+                if update and destination_names and \
+                        not client.is_remote_file(source_name):
+                    # hash the local files that will need an MD5
+                    # comparison together so that the misses run in parallel
+                    existing = set(destination_names)
+                    candidates = []
+                    for filename in source_names:
+                        local_name = os.path.join(source_name, filename)
+                        if filename in existing and os.path.isfile(local_name) and \
+                                get_size(local_name) == get_size(
+                                    os.path.join(destination_name, filename)):
+                            candidates.append(local_name)
+                    get_checksum_index().md5_many(candidates, jobs)
+                for filename in source_names:
                     logging.debug("%s -> %s" % (filename, source_name))
                     copy_file(os.path.join(source_name, filename),
                          os.path.join(destination_name, filename),
-                         exclude_arg, include_arg, interrogate_arg, overwrite, ignore_arg,
-                         head_arg)
+                         os.path.join(relative_name, filename),
+                         interrogate_arg, overwrite, ignore_arg, head_arg)
+                if delete:
+                    for filename in sorted(set(destination_names) - set(source_names)):
+                        extra_name = os.path.join(destination_name, filename)
+                        # like rsync, filtered names are protected from --delete
+                        if not path_filter or not path_filter.skip(
+                                os.path.join(relative_name, filename),
+                                isdir(extra_name)):
+                            remove(extra_name)
             else:
+                if bundle and client.is_remote_file(source_name) and \
+                        not client.is_remote_file(destination_name) and \
+                        BUNDLE_PATTERN.match(os.path.basename(source_name)):
+                    extract_bundle(source_name, destination_name)
+                    return
+                if bundle and source_name.endswith(BUNDLE_INDEX) and \
+                        BUNDLE_PATTERN.match(os.path.basename(
+                            source_name)[:-len(BUNDLE_INDEX)]):
+                    # index of a bundle, only used to extract it
+                    return
+
+                if journal is not None and journal.is_done(
+                        source_name, destination_name,
+                        destination_name if client.is_remote_file(source_name)
+                        else source_name):
+                    logging.info("%s: done in journal" % destination_name)
+                    with Nonlocal.lock:
+                        Nonlocal.journaled += 1
+                    return
+
+                if update and not head_arg and not has_cutout(source_name) \
+                        and is_unchanged(source_name, destination_name):
+                    logging.info("%s: unchanged" % destination_name)
+                    with Nonlocal.lock:
+                        Nonlocal.unchanged += 1
+                    return
+
                 if interrogate_arg:
                     if access(destination_name, os.F_OK):
                         sys.stderr.write(
@@ -291,65 +2454,188 @@ def cp(
                         if ans != 'y':
                             raise Exception("File exists")
 
-                skip = False
-                if exclude_arg is not None:
-                    for thisIgnore in exclude_arg.split(','):
-                        if not destination_name.find(thisIgnore) < 0:
-                            skip = True
-                            continue
-
-                if include_arg is not None:
-                    skip = True
-                    for thisIgnore in include_arg.split(','):
-                        if not destination_name.find(thisIgnore) < 0:
-                            skip = False
-                            continue
-
-                if not skip:
-                    logging.info("%s -> %s " % (source_name, destination_name))
-                niters = 0
-                while not skip:
-                    try:
-                        logging.debug("Starting call to copy")
-                        client.copy(source_name, destination_name, head=head_arg)
-                        logging.debug("Call to copy returned")
-                        break
-                    except Exception as client_exception:
-                        logging.debug("{}".format(client_exception))
-                        if getattr(client_exception, 'errno', -1) == 104:
-                            # 104 is connection reset by peer.
-                            # Try again on this error
-                            logging.warning(str(client_exception))
-                            Nonlocal.exit_code += \
-                                getattr(client_exception, 'errno', -1)
-                        elif getattr(client_exception, 'errno', -1) == errno.EIO:
-                            # retry on IO errors
-                            logging.warning(
-                                "{0}: Retrying".format(client_exception))
-                            pass
-                        elif ignore_arg:
-                            if niters > 100:
-                                logging.error(
-                                    "%s (skipping after %d attempts)" % (
-                                        str(client_exception), niters))
-                                skip = True
-                            else:
-                                logging.error(
-                                    "%s (retrying)" % str(client_exception))
-                                time.sleep(5)
-                                niters += 1
-                        else:
-                            raise client_exception
+                logging.info("%s -> %s " % (source_name, destination_name))
+                if dry_run:
+                    typer.echo("{} -> {}".format(source_name, destination_name))
+                    with Nonlocal.lock:
+                        Nonlocal.files += 1
+                        Nonlocal.bytes += 0 if has_cutout(source_name) \
+                            else get_size(source_name)
+                elif bundle and client.is_remote_file(destination_name) and \
+                        not client.is_remote_file(source_name) and \
+                        get_size(source_name) < bundle_threshold_bytes:
+                    add_to_bundle(source_name, destination_name)
+                elif client.is_remote_file(source_name) and \
+                        client.is_remote_file(destination_name):
+                    if head_arg or has_cutout(source_name):
+                        raise OSError(errno.ENOTSUP,
+                                      "--head and cutouts can not be copied "
+                                      "to VOSpace: {}".format(source_name))
+                    remote_copies.submit(source_name, destination_name)
+                elif pool is None:
+                    transfer(source_name, destination_name, ignore_arg, head_arg)
+                else:
+                    # keep the queue short so that a huge tree is not
+                    # buffered in memory ahead of the workers
+                    wait_pending(2 * jobs)
+                    pending.add(pool.submit(transfer, source_name,
+                                            destination_name, ignore_arg,
+                                            head_arg))
 
         except OSError as os_exception:
-            logging.debug(str(os_exception))
-            if getattr(os_exception, 'errno', -1) == errno.EINVAL:
-                # not a valid uri, just skip those...
-                logging.warning("%s: Skipping" % str(os_exception))
-                Nonlocal.exit_code += getattr(os_exception, 'errno', -1)
-            else:
-                typer.echo(f"Error: {os_exception}", err=True)
-                raise typer.Exit(1)
+            handle_os_error(os_exception)
+
+    targets = None
+    if targets_file is not None:
+        try:
+            targets = _read_cutout_targets(targets_file)
+        except (OSError, ValueError) as ex:
+            raise typer.BadParameter(str(ex), param_hint="--targets")
+        for source_pattern in source:
+            if not client.is_remote_file(source_pattern):
+                raise typer.BadParameter(
+                    "{}: cutouts can only be taken from VOSpace "
+                    "files".format(source_pattern), param_hint="--targets")
+            if has_cutout(source_pattern):
+                raise typer.BadParameter(
+                    "{}: give cutouts either in the source or with "
+                    "--targets".format(source_pattern), param_hint="--targets")
+        if client.is_remote_file(dest):
+            raise typer.BadParameter(
+                "cutouts can only be copied to a local directory",
+                param_hint="--targets")
+    if jobs is None:
+        # cutouts are small and slow to make, so ask for several by default
+        jobs = CUTOUT_JOBS if targets or any(
+            client.is_remote_file(s) and has_cutout(s) for s in source) else 1
+
+    # with more than one job the tree is still walked by this thread,
+    # only the file transfers are handed to the pool
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs) \
+        if jobs > 1 else None
+    pending = set()
+    start_time = time.time()
+    journal = CopyJournal(journal_file) \
+        if journal_file is not None and not dry_run else None
+    try:
+        stream_threshold_bytes = _parse_size(stream_threshold)
+    except ValueError:
+        raise typer.BadParameter("not a size: {}".format(stream_threshold),
+                                 param_hint="--stream-threshold")
+
+    path_filter = PathFilter(exclude, include)
+
+    if bundle and (update or delete):
+        # the archives do not line up with the source files, so neither
+        # the per file comparison nor the stale file check would be right
+        raise typer.BadParameter("can not be used with -u or --delete",
+                                 param_hint="--bundle")
+    try:
+        bundle_threshold_bytes = _parse_size(bundle_threshold)
+        bundle_size_bytes = _parse_size(bundle_size)
+    except ValueError:
+        raise typer.BadParameter("not a size: {} or {}".format(
+            bundle_threshold, bundle_size), param_hint="--bundle-threshold/--bundle-size")
+    bundle_stamp = time.strftime('%Y%m%dT%H%M%S')
+
+    def send_bundle(tar_bundle):
+        try:
+            size = get_retry_policy().call(tar_bundle.upload, client)
+            node_cache.invalidate(tar_bundle.destination)
+            node_cache.invalidate(tar_bundle.destination + BUNDLE_INDEX)
+            logging.info("{}: {} files".format(tar_bundle.destination,
+                                               len(tar_bundle)))
+            with Nonlocal.lock:
+                Nonlocal.bundles += 1
+                Nonlocal.files += len(tar_bundle)
+                Nonlocal.bytes += size
+        except Exception as client_exception:
+            if not ignore:
+                raise client_exception
+            logging.error("%s (skipping)" % str(client_exception))
+            with Nonlocal.lock:
+                Nonlocal.exit_code = \
+                    getattr(client_exception, 'errno', None) or 1
+
+    def flush_bundle():
+        tar_bundle, Nonlocal.bundle = Nonlocal.bundle, None
+        if tar_bundle is None:
+            return
+        if pool is None:
+            send_bundle(tar_bundle)
+        else:
+            wait_pending(2 * jobs)
+            pending.add(pool.submit(send_bundle, tar_bundle))
+
+    def add_to_bundle(source_name, destination_name):
+        if Nonlocal.bundle is None:
+            Nonlocal.bundles_started += 1
+            Nonlocal.bundle = TarBundle(os.path.join(
+                Nonlocal.bundle_root, 'cvos-bundle-{}-{:04d}.tar'.format(
+                    bundle_stamp, Nonlocal.bundles_started)))
+        Nonlocal.bundle.add(source_name,
+                            destination_name[len(Nonlocal.bundle_root) + 1:])
+        if Nonlocal.bundle.size >= bundle_size_bytes:
+            flush_bundle()
+
+    def extract_bundle(source_name, destination_name):
+        # members go next to where the archive would have been copied,
+        # or into the destination named on the command line if that is
+        # not an existing directory
+        directory = destination_name if destination_name == dest and \
+            not os.path.isdir(dest) else os.path.dirname(destination_name)
+        if dry_run:
+            typer.echo("extract {} -> {}".format(source_name, directory))
+            return
+        count, size = _extract_bundle(client, source_name, directory, member)
+        with Nonlocal.lock:
+            Nonlocal.bundles += 1
+            Nonlocal.files += count
+            Nonlocal.bytes += size
+
+    def remote_copy_done(source_name, destination_name, error):
+        if error is not None:
+            if not ignore:
+                raise error
+            logging.error("%s (skipping)" % str(error))
+            with Nonlocal.lock:
+                Nonlocal.exit_code = getattr(error, 'errno', None) or 1
+            return
+        node_cache.invalidate(destination_name)
+        with Nonlocal.lock:
+            Nonlocal.files += 1
+            Nonlocal.bytes += get_size(source_name)
+
+    def remote_copy_fallback(source_name, destination_name):
+        if pool is None:
+            transfer(source_name, destination_name, ignore)
+        else:
+            wait_pending(2 * jobs)
+            pending.add(pool.submit(transfer, source_name, destination_name,
+                                    ignore))
+
+    def copy_targets(sources):
+        """Copy every --targets cutout of every source into dest"""
+        if not dry_run:
+            os.makedirs(dest, exist_ok=True)
+        for source_name in sources:
+            filename = os.path.basename(source_name)
+            for target_cutout, label in targets:
+                name = _cutout_name(filename, label)
+                duplicates = used_names.get(name, 0)
+                used_names[name] = duplicates + 1
+                if duplicates:
+                    # the same file name in several source directories
+                    name = _cutout_name(filename, "{}-{}".format(
+                        label, duplicates + 1))
+                copy_file(source_name + target_cutout, os.path.join(dest, name),
+                          relative_name=filename, interrogate_arg=interrogate,
+                          ignore_arg=ignore, head_arg=head)
+    used_names = {}
+
+    # VOSpace to VOSpace copies run as jobs on the service
+    remote_copies = RemoteCopyJobs(client, max(jobs, REMOTE_COPY_JOBS),
+                                   remote_copy_done, remote_copy_fallback)
 
     # main loop
     source_arg = source[0]
@@ -375,31 +2661,35 @@ def cp(
                 else:
                     ra_dec_match = ra_dec_cutout_pattern.search(source_pattern)
                     if ra_dec_match is not None:
+                        source_pattern = ra_dec_match.group(1)
                         cutout = ra_dec_match.group('cutout')
                 logging.debug("cutout: {}".format(cutout))
                 sources = lglob(source_pattern)
                 if cutout is not None:
                     # stick back on the cutout pattern if there was one.
                     sources = [s + cutout for s in sources]
+            if targets:
+                copy_targets(sources)
+                continue
             for source_arg in sources:
                 if not client.is_remote_file(source_arg):
                     source_arg = os.path.abspath(source_arg)
+                # cutouts are of the files the glob found, the service
+                # reports any that can not be read when they are copied
+                cutout_source = client.is_remote_file(source_arg) and \
+                    has_cutout(source_arg)
                 # the source must exist, of course...
-                if not access(source_arg, os.R_OK):
+                if not cutout_source and not access(source_arg, os.R_OK):
                     raise Exception("Can't access source: %s " % source_arg)
 
-                if not follow_links and islink(source_arg):
+                if not cutout_source and not follow_links and \
+                        islink(source_arg):
                     logging.info("{}: Skipping (symbolic link)".format(source_arg))
                     continue
 
-                # copying inside VOSpace not yet implemented
-                if client.is_remote_file(source_arg) and \
-                   client.is_remote_file(dest):
-                    raise Exception(
-                        "Can not (yet) copy from VOSpace to VOSpace.")
-
                 this_destination = dest
-                if isdir(source_arg):
+                source_is_dir = not cutout_source and isdir(source_arg)
+                if source_is_dir:
                     if not follow_links and islink(source_arg):
                         continue
                     logging.debug("%s is a directory or link to one" % source_arg)
@@ -426,10 +2716,20 @@ def cp(
                     # we're copying into a directory
                     this_destination = os.path.join(dest,
                                                     os.path.basename(source_arg))
-                copy_file(source_arg, this_destination, exclude_arg=exclude,
-                     include_arg=include,
+                # bundled files are named relative to the directory
+                # being copied into
+                Nonlocal.bundle_root = this_destination if source_is_dir \
+                    else os.path.dirname(this_destination)
+                # a directory is the root of the relative names, a file
+                # is matched by its name
+                copy_file(source_arg, this_destination,
+                     relative_name='' if source_is_dir
+                     else os.path.basename(source_arg),
                      interrogate_arg=interrogate, overwrite=False,
                      ignore_arg=ignore, head_arg=head)
+                flush_bundle()
+        remote_copies.wait()
+        wait_pending(0)
 
     except KeyboardInterrupt as ke:
         logging.info("Received keyboard interrupt. Execution aborted...\n")
@@ -446,6 +2746,32 @@ def cp(
         else:
             typer.echo(f"Error: {e}", err=True)
         raise typer.Exit(1)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if journal is not None:
+            journal.close()
+
+    logging.info(node_cache.stats())
+    if pool is not None or update or delete or dry_run or journal is not None \
+            or streams > 1 or path_filter or bundle:
+        elapsed = max(time.time() - start_time, 1e-6)
+        summary = "{} {} files ({}) in {:.1f}s, {}/s".format(
+            "would copy" if dry_run else "copied", Nonlocal.files,
+            _format_bytes(Nonlocal.bytes), elapsed,
+            _format_bytes(Nonlocal.bytes / elapsed))
+        if update:
+            summary += ", {} unchanged".format(Nonlocal.unchanged)
+        if delete:
+            summary += ", {} deleted".format(Nonlocal.deleted)
+        if journal is not None:
+            summary += ", {} already done".format(Nonlocal.journaled)
+        if bundle:
+            summary += ", {} bundles".format(Nonlocal.bundles)
+        if path_filter:
+            summary += ", {} files filtered, {} directories skipped " \
+                "without listing".format(Nonlocal.filtered, Nonlocal.pruned)
+        typer.echo("{}, {}".format(summary, node_cache.stats()), err=True)
 
     if Nonlocal.exit_code:
         raise typer.Exit(Nonlocal.exit_code)
@@ -453,15 +2779,32 @@ def cp(
 @app.command()
 def rm(
     node: list[str] = typer.Argument(..., help="file, link or possibly directory to delete from VOSpace"),
-    recursive: bool = typer.Option(False, "-R", "--recursive", help="Delete a file or directory even if it's not empty.")
+    recursive: bool = typer.Option(False, "-R", "--recursive", help="Delete a file or directory even if it's not empty."),
+    jobs: int = typer.Option(1, "-j", "--jobs", min=1, help="with -R, walk the tree here and delete this many nodes concurrently"),
+    failures_file: str = typer.Option(None, "--failures", help="with -R, write the nodes that could not be deleted to this file, one per line")
 ):
     """Remove a vospace data node; fails if container node or node is locked."""
+    if failures_file is not None and not recursive:
+        raise typer.BadParameter("only used with -R", param_hint="--failures")
+    client = get_client()
+    # the service's recursive delete only counts its failures, walking
+    # the tree here tells which nodes failed
+    walk = recursive and (jobs > 1 or failures_file is not None)
 
+    failed = []
+    progress = _Progress('deleted', 'failed')
     try:
         for node_path in node:
             if not client.is_remote_file(node_path):
                 raise Exception(
                     '{} is not a valid VOSpace handle'.format(node_path))
+            get_node_cache().invalidate(node_path, recursive=True)
+        if walk:
+            failed = _delete_tree(client, node, jobs, progress)
+            progress.finish()
+        for node_path in node:
+            if walk:
+                continue
             if recursive:
                 successes, failures = client.recursive_delete(node_path)
                 if failures:
@@ -488,12 +2831,23 @@ def rm(
         typer.echo(f"Error: {ex}", err=True)
         raise typer.Exit(1)
 
+    if failed:
+        for uri, reason in failed:
+            logging.error("{}: {}".format(uri, reason))
+        if failures_file is not None:
+            with open(failures_file, 'w') as f:
+                f.writelines(uri + '\n' for uri, _ in failed)
+            typer.echo("{} failed deletes written to {}".format(
+                len(failed), failures_file), err=True)
+        raise typer.Exit(1)
+
 @app.command()
 def mkdir(
     container_node: str = typer.Argument(..., help="Name of the container node to create"),
     parents: bool = typer.Option(False, "-p", help="Create intermediate directories as required")
 ):
     """Create a new VOSpace ContainerNode (directory)."""
+    client = get_client()
 
     logging.info(
         "Creating ContainerNode (directory) {}".format(container_node))
@@ -509,8 +2863,10 @@ def mkdir(
             while len(dir_names) > 0:
                 this_dir = os.path.join(this_dir, dir_names.pop())
                 client.mkdir(this_dir)
+                get_node_cache().invalidate(this_dir)
         else:
             client.mkdir(this_dir)
+            get_node_cache().invalidate(this_dir)
 
     except Exception as ex:
         typer.echo(f"Error: {ex}", err=True)
@@ -522,6 +2878,7 @@ def mv(
     destination: str = typer.Argument(..., help="VOSpace destination to move source to")
 ):
     """Move node to newNode, if newNode is a container then move node into newNode."""
+    client = get_client()
 
     try:
         if not client.is_remote_file(source):
@@ -533,10 +2890,751 @@ def mv(
             raise ValueError('Move between services not supported')
         logging.info("{} -> {}".format(source, destination))
         client.move(source, destination)
+        # both trees changed, for later commands of a batch
+        get_node_cache().invalidate(source, recursive=True)
+        get_node_cache().invalidate(destination, recursive=True)
+    except Exception as ex:
+        typer.echo(f"Error: {ex}", err=True)
+        raise typer.Exit(1)
+
+
+@app.command()
+def du(
+    node: list[str] = typer.Argument(..., help="VOSpace nodes to total"),
+    human: bool = typer.Option(False, "--human", "-h", help="make sizes human readable"),
+    summarize: bool = typer.Option(False, "-s", "--summarize", help="only print the total of each node"),
+    max_depth: int = typer.Option(None, "-d", "--max-depth", min=0, help="only print totals of directories this far below the node"),
+    jobs: int = typer.Option(8, "-j", "--jobs", min=1, help="number of directory listings in flight")
+):
+    """Show the total size of VOSpace directories."""
+    client = get_client()
+    global human_readable
+    human_readable = human
+    if summarize:
+        max_depth = 0
+
+    out = _BatchedOutput()
+    # directory -> [bytes, subdirectories not yet totalled, depth, listed]
+    totals = {}
+    failed = []
+
+    def finish(uri):
+        # a directory is done once it and all its subdirectories are
+        # listed, which may complete its parents in turn
+        while totals[uri][3] and totals[uri][1] == 0:
+            size, _, depth, _ = totals.pop(uri)
+            if max_depth is None or depth <= max_depth:
+                out.write("{}{}\n".format(size_format(size), uri))
+            if depth == 0:
+                return
+            uri = os.path.dirname(uri)
+            totals[uri][0] += size
+            totals[uri][1] -= 1
+
+    try:
+        roots = []
+        for this_node in node:
+            if not client.is_remote_file(this_node):
+                raise ValueError('{} is not a valid VOSpace handle'.format(this_node))
+            root = client.get_node(this_node, limit=0)
+            if root.isdir():
+                roots.append(this_node.rstrip('/'))
+            else:
+                out.write("{}{}\n".format(
+                    size_format(root.props.get('length', 0)), this_node))
+        # like du, a directory that is also below another root is only
+        # counted with that root
+        for root in list(roots):
+            if roots.count(root) > 1 or any(
+                    root.startswith(other + '/') for other in roots):
+                logging.info("{}: already counted".format(root))
+                roots.remove(root)
+        for root in roots:
+            totals[root] = [0, 0, 0, False]
+
+        for uri, depth, children in _walk_tree(client, roots, jobs):
+            if isinstance(children, Exception):
+                failed.append(uri)
+                typer.echo("Error: {}: {}".format(uri, children), err=True)
+                children = []
+            for child in children:
+                if child.isdir():
+                    totals['{}/{}'.format(uri, child.name)] = [0, 0, depth + 1, False]
+                    totals[uri][1] += 1
+                elif not child.islink():
+                    totals[uri][0] += int(child.props.get('length') or 0)
+            totals[uri][3] = True
+            finish(uri)
+            out.flush()
+    except Exception as ex:
+        typer.echo(f"Error: {ex}", err=True)
+        raise typer.Exit(1)
+    finally:
+        out.flush()
+
+    if failed:
+        raise typer.Exit(1)
+
+
+class NodeType(str, Enum):
+    f = "f"
+    d = "d"
+    l = "l"
+
+
+def _size_test(size):
+    """Predicate on a length for find --size: +N more than, -N less than
+    and N exactly N bytes (with K, M, G, T suffixes)"""
+    if size[:1] in '+-':
+        limit = _parse_size(size[1:])
+        if size[0] == '+':
+            return lambda length: length > limit
+        return lambda length: length < limit
+    limit = _parse_size(size)
+    return lambda length: length == limit
+
+
+@app.command()
+def find(
+    node: list[str] = typer.Argument(..., help="VOSpace directories to search"),
+    name: str = typer.Option(None, "--name", help="glob the node name must match, e.g. '*.fits'"),
+    node_type: NodeType = typer.Option(None, "--type", help="f for data nodes, d for containers, l for links"),
+    size: str = typer.Option(None, "--size", help="+N larger than, -N smaller than or exactly N bytes; K, M, G and T suffixes allowed"),
+    newer: str = typer.Option(None, "--newer", help="modified after this node, or this date (YYYY-MM-DD[THH:MM:SS], UTC)"),
+    mtime: float = typer.Option(None, "--mtime", help="modified more than N days ago, or less than -N days ago"),
+    max_depth: int = typer.Option(None, "--max-depth", "--maxdepth", min=0, help="do not descend more than this many levels"),
+    jobs: int = typer.Option(8, "-j", "--jobs", min=1, help="number of directory listings in flight")
+):
+    """Search VOSpace directories for nodes by name, type, size and date."""
+    from vos.vos import convert_vospace_time_to_seconds
+    client = get_client()
+
+    tests = []
+    if name is not None:
+        tests.append(lambda child: fnmatch.fnmatchcase(child.name, name))
+    if node_type is not None:
+        kind = {'f': 'vos:DataNode', 'd': 'vos:ContainerNode',
+                'l': 'vos:LinkNode'}[node_type.value]
+        tests.append(lambda child: child.type == kind)
+    if size is not None:
+        try:
+            size_test = _size_test(size)
+        except ValueError:
+            raise typer.BadParameter("not a size: {}".format(size),
+                                     param_hint="--size")
+        tests.append(lambda child: not child.isdir() and
+                     size_test(int(child.props.get('length') or 0)))
+
+    def node_time(child):
+        return convert_vospace_time_to_seconds(child.props['date'])
+    if newer is not None:
+        if client.is_remote_file(newer):
+            since = node_time(client.get_node(newer, limit=0))
+        else:
+            try:
+                since = convert_vospace_time_to_seconds(
+                    newer if 'T' in newer else newer + 'T00:00:00')
+            except ValueError:
+                raise typer.BadParameter("not a node or date: {}".format(newer),
+                                         param_hint="--newer")
+        tests.append(lambda child: node_time(child) > since)
+    if mtime is not None:
+        age = abs(mtime) * 86400
+        if mtime < 0:
+            tests.append(lambda child: time.time() - node_time(child) < age)
+        else:
+            tests.append(lambda child: time.time() - node_time(child) > age)
+
+    def descend(uri, depth, child):
+        return max_depth is None or depth < max_depth
+
+    out = _BatchedOutput()
+    failed = False
+    try:
+        roots = []
+        for this_node in node:
+            if not client.is_remote_file(this_node):
+                raise ValueError('{} is not a valid VOSpace handle'.format(this_node))
+            root = client.get_node(this_node, limit=0)
+            if root.isdir():
+                roots.append(this_node)
+            elif all(test(root) for test in tests):
+                # a file is tested itself, the listing of a data node
+                # would give the node again as its own child
+                out.write("{}\n".format(this_node))
+        for uri, depth, children in _walk_tree(client, roots, jobs, descend):
+            if isinstance(children, Exception):
+                failed = True
+                typer.echo("Error: {}: {}".format(uri, children), err=True)
+                continue
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for child in children:
+                if all(test(child) for test in tests):
+                    out.write("{}/{}\n".format(uri, child.name))
+            out.flush()
+    except Exception as ex:
+        typer.echo(f"Error: {ex}", err=True)
+        raise typer.Exit(1)
+    finally:
+        out.flush()
+
+    if failed:
+        raise typer.Exit(1)
+
+def _parse_fits_header(text):
+    """Split the text of a header view into one {keyword: value} dict per
+    HDU.  Cards may be newline separated or packed 80 characters each."""
+    if '\n' not in text.strip():
+        text = '\n'.join(text[i:i + 80] for i in range(0, len(text), 80))
+    hdus = [{}]
+    for card in text.splitlines():
+        keyword = card[:8].strip()
+        if keyword == 'END':
+            hdus.append({})
+            continue
+        if card[8:10] != '= ' or keyword in hdus[-1]:
+            continue
+        value = card[10:].strip()
+        if value.startswith("'"):
+            # quotes inside a string are doubled
+            match = re.match(r"'((?:[^']|'')*)'", value)
+            value = match.group(1).replace("''", "'").rstrip() if match else value
+        else:
+            value = value.split('/', 1)[0].strip()
+        hdus[-1][keyword] = value
+    return [hdu for hdu in hdus if hdu]
+
+
+def _header_extension(cutout):
+    """HDU picked by a cutout such as [1] or [1][10:20,10:20], None when
+    the cutout does not name one"""
+    match = re.match(r'\[(\d+)\]', cutout or '')
+    return int(match.group(1)) if match else None
+
+
+class HeaderFormat(str, Enum):
+    csv = "csv"
+    sqlite = "sqlite"
+    parquet = "parquet"
+
+
+class HeaderCatalog(object):
+    """Selected header keywords of a set of VOSpace files, one row each.
+
+    Rows carry the date and MD5 the node had when its header was read, so
+    a later harvest into the same file only fetches headers of nodes that
+    changed.  SQLite rows are written as they arrive; CSV and Parquet
+    files are rewritten when the catalog is closed.
+    """
+
+    FIELDS = ['uri', 'date', 'md5']
+
+    def __init__(self, filename, catalog_format, keywords):
+        self.filename = filename
+        self.format = catalog_format
+        self.keywords = keywords
+        self.columns = self.FIELDS + keywords
+        self.rows = {}
+        self._db = None
+        if catalog_format == HeaderFormat.sqlite:
+            self._db = sqlite3.connect(filename)
+            self._db.execute('CREATE TABLE IF NOT EXISTS headers '
+                             '(uri TEXT PRIMARY KEY, date TEXT, md5 TEXT)')
+            existing = [row[1] for row in
+                        self._db.execute('PRAGMA table_info(headers)')]
+            added = [keyword for keyword in keywords if keyword not in existing]
+            for keyword in added:
+                self._db.execute('ALTER TABLE headers ADD COLUMN "{}" '
+                                 'TEXT'.format(keyword))
+            if not added:
+                # with a new keyword every header is read again
+                for uri, date, md5 in self._db.execute(
+                        'SELECT uri, date, md5 FROM headers'):
+                    self.rows[uri] = {'uri': uri, 'date': date, 'md5': md5}
+        elif filename != '-' and os.path.exists(filename):
+            if catalog_format == HeaderFormat.parquet:
+                import pyarrow.parquet
+                for row in pyarrow.parquet.read_table(filename).to_pylist():
+                    self.rows[row['uri']] = row
+            else:
+                with open(filename, newline='') as f:
+                    for row in csv.DictReader(f):
+                        self.rows[row['uri']] = row
+
+    def is_current(self, uri, date, md5):
+        row = self.rows.get(uri)
+        # CSV has no nulls, so compare empty values as None
+        return row is not None and (row['date'] or None) == (date or None) \
+            and (row['md5'] or None) == (md5 or None) \
+            and (self._db is not None or all(k in row for k in self.keywords))
+
+    @_profiled('catalog.add')
+    def add(self, row):
+        self.rows[row['uri']] = row
+        if self._db is not None:
+            self._db.execute(
+                'INSERT OR REPLACE INTO headers ({}) VALUES ({})'.format(
+                    ', '.join('"{}"'.format(c) for c in self.columns),
+                    ', '.join('?' * len(self.columns))),
+                [row.get(c) for c in self.columns])
+
+    @_profiled('catalog.write')
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            return
+        rows = [self.rows[uri] for uri in sorted(self.rows)]
+        if self.format == HeaderFormat.parquet:
+            import pyarrow
+            import pyarrow.parquet
+            table = pyarrow.table({c: [row.get(c) for row in rows]
+                                   for c in self.columns})
+            pyarrow.parquet.write_table(table, self.filename + '.part')
+            os.replace(self.filename + '.part', self.filename)
+            return
+        if self.filename == '-':
+            self._write_csv(sys.stdout, rows)
+            return
+        with open(self.filename + '.part', 'w', newline='') as f:
+            self._write_csv(f, rows)
+        os.replace(self.filename + '.part', self.filename)
+
+    def _write_csv(self, f, rows):
+        writer = csv.DictWriter(f, self.columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+@app.command()
+def headers(
+    node: list[str] = typer.Argument(..., help="VOSpace files, patterns or directories, optionally with an extension e.g. vos:dir/*.fits[1]"),
+    keywords: list[str] = typer.Option(..., "-k", "--keywords", help="header keywords to collect, comma separated or repeated"),
+    output: str = typer.Option('-', "-o", "--output", help="catalog file, updated incrementally; - for CSV on stdout"),
+    catalog_format: HeaderFormat = typer.Option(None, "--format", help="catalog format, by default from the --output extension (.csv, .sqlite/.db, .parquet)"),
+    name: str = typer.Option('*.fits*', "--name", help="glob for the files to read inside directories"),
+    jobs: int = typer.Option(8, "-j", "--jobs", min=1, help="number of headers fetched concurrently")
+):
+    """Collect FITS header keywords of VOSpace files into one catalog."""
+    client = get_client()
+    keywords = [k.strip().upper() for arg in keywords for k in arg.split(',')
+                if k.strip()]
+    if catalog_format is None:
+        extension = os.path.splitext(output)[1].lower()
+        catalog_format = {'.sqlite': HeaderFormat.sqlite, '.db': HeaderFormat.sqlite,
+                          '.parquet': HeaderFormat.parquet}.get(extension, HeaderFormat.csv)
+    if output == '-' and catalog_format != HeaderFormat.csv:
+        raise typer.BadParameter("only CSV can be written to stdout",
+                                 param_hint="--output")
+    if catalog_format == HeaderFormat.parquet:
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            typer.echo("Error: Parquet output needs the pyarrow package", err=True)
+            raise typer.Exit(1)
+
+    class Nonlocal():
+        fetched = 0
+        unchanged = 0
+        failed = 0
+
+    def fetch(uri, cutout, date, md5):
+        text = _timed('http.read', client.open(uri, view='header').read,
+                      size=lambda text, *args: len(text))
+        if isinstance(text, bytes):
+            text = text.decode('latin-1')
+        hdus = _parse_fits_header(text)
+        extension = _header_extension(cutout)
+        if extension is not None:
+            hdus = hdus[extension:extension + 1]
+        row = {'uri': uri + (cutout or ''), 'date': date, 'md5': md5}
+        for keyword in keywords:
+            # without an extension the first HDU that has the keyword
+            row[keyword] = next((hdu[keyword] for hdu in hdus
+                                 if keyword in hdu), None)
+        return row
+
+    def wait_pending(limit):
+        while len(pending) > limit:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                uri = pending_uris.pop(future)
+                try:
+                    catalog.add(future.result())
+                    Nonlocal.fetched += 1
+                except Exception as ex:
+                    Nonlocal.failed += 1
+                    logging.error("{}: {}".format(uri, ex))
+
+    def submit(uri, cutout, child):
+        date = child.props.get('date')
+        md5 = child.props.get('MD5')
+        if catalog.is_current(uri + (cutout or ''), date, md5):
+            Nonlocal.unchanged += 1
+            return
+        wait_pending(2 * jobs)
+        future = pool.submit(get_retry_policy().call, fetch, uri, cutout,
+                             date, md5)
+        pending.add(future)
+        pending_uris[future] = uri
+
+    catalog = HeaderCatalog(output, catalog_format, keywords)
+    pending = set()
+    pending_uris = {}
+    start_time = time.time()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            for pattern in node:
+                if not client.is_remote_file(pattern):
+                    raise ValueError('{} is not a valid VOSpace handle'.format(pattern))
+                cutout_match = cutout_pattern.search(pattern)
+                cutout = None
+                if cutout_match is not None:
+                    pattern = cutout_match.group(1)
+                    cutout = cutout_match.group('cutout')
+                directories = []
+                # the matches are looked up concurrently, as the headers are
+                targets = _ordered_map(
+                    lambda target: (target, client.get_node(target, limit=0)),
+                    client.glob(pattern), jobs)
+                for target, target_node in targets:
+                    if target_node.isdir():
+                        directories.append(target)
+                    elif not target_node.islink():
+                        submit(target, cutout, target_node)
+                for uri, depth, children in _walk_tree(client, directories, jobs):
+                    if isinstance(children, Exception):
+                        Nonlocal.failed += 1
+                        logging.error("{}: {}".format(uri, children))
+                        continue
+                    for child in children:
+                        if child.type == 'vos:DataNode' and \
+                                fnmatch.fnmatchcase(child.name, name):
+                            submit('{}/{}'.format(uri, child.name), cutout, child)
+            wait_pending(0)
+    except Exception as ex:
+        typer.echo(f"Error: {ex}", err=True)
+        raise typer.Exit(1)
+    finally:
+        catalog.close()
+
+    typer.echo("{} headers read, {} unchanged, {} failed in {:.1f}s".format(
+        Nonlocal.fetched, Nonlocal.unchanged, Nonlocal.failed,
+        time.time() - start_time), err=True)
+    if Nonlocal.failed:
+        raise typer.Exit(1)
+
+index_app = typer.Typer(help="Keep a local snapshot of VOSpace trees for ls --cached.")
+app.add_typer(index_app, name="index")
+
+
+@index_app.command("refresh")
+def index_refresh(
+    root: list[str] = typer.Argument(None, help="VOSpace directories to add to the snapshot or bring up to date, by default every indexed root"),
+    full: bool = typer.Option(False, "--full", help="list every container, not only those whose date changed"),
+    jobs: int = typer.Option(8, "-j", "--jobs", min=1, help="number of directory listings in flight"),
+    index: str = typer.Option(SNAPSHOT_INDEX, "--index", help="location of the snapshot index")
+):
+    """Add VOSpace trees to the snapshot index or refresh them."""
+    client = get_client()
+    snapshot = SnapshotIndex(index)
+    roots = root or [uri for uri, _, _ in snapshot.roots()]
+    if not roots:
+        typer.echo("Error: no roots in {}, give one to index".format(index), err=True)
+        raise typer.Exit(1)
+
+    failed = []
+    progress = _Progress('listed', 'unchanged', 'failed')
+    try:
+        for this_root in roots:
+            if not client.is_remote_file(this_root):
+                raise ValueError('{} is not a valid VOSpace handle'.format(this_root))
+            failed.extend(snapshot.refresh(client, this_root, jobs, progress, full))
     except Exception as ex:
         typer.echo(f"Error: {ex}", err=True)
         raise typer.Exit(1)
+    progress.finish()
+    if failed:
+        raise typer.Exit(1)
+
+
+@index_app.command("list")
+def index_list(
+    index: str = typer.Option(SNAPSHOT_INDEX, "--index", help="location of the snapshot index")
+):
+    """Show the indexed roots, their size and age."""
+    for uri, refreshed, nodes in SnapshotIndex(index).roots():
+        typer.echo("{:>10} nodes  {:>8.0f}s old  {}".format(
+            nodes, time.time() - refreshed, uri))
+
+
+@index_app.command("drop")
+def index_drop(
+    root: list[str] = typer.Argument(..., help="indexed roots to remove"),
+    index: str = typer.Option(SNAPSHOT_INDEX, "--index", help="location of the snapshot index")
+):
+    """Remove trees from the snapshot index."""
+    client = get_client()
+    snapshot = SnapshotIndex(index)
+    for this_root in root:
+        snapshot.drop(client.fix_uri(this_root).rstrip('/'))
+
+@app.command("hash-index")
+def hash_index(
+    path: list[str] = typer.Argument(None, help="local files or directories to add to the index"),
+    prune: bool = typer.Option(False, "--prune", help="drop entries for files that were deleted or changed"),
+    jobs: int = typer.Option(4, "-j", "--jobs", min=1, help="number of files to hash concurrently"),
+    index: str = typer.Option(CHECKSUM_INDEX, "--index", help="location of the checksum index")
+):
+    """Build or prune the local MD5 index used by cp --update."""
+    global _checksum_index
+    _checksum_index = checksum_index = ChecksumIndex(index)
+
+    if prune:
+        typer.echo("pruned {} entries".format(checksum_index.prune()), err=True)
+
+    filenames = []
+    for this_path in path or []:
+        if os.path.isdir(this_path):
+            for dirpath, _, names in os.walk(this_path):
+                filenames.extend(os.path.join(dirpath, name) for name in names
+                                 if os.path.isfile(os.path.join(dirpath, name)))
+        elif os.path.isfile(this_path):
+            filenames.append(this_path)
+        else:
+            typer.echo("Error: {} is not a local file or directory".format(
+                this_path), err=True)
+            raise typer.Exit(1)
+
+    if filenames:
+        start_time = time.time()
+        checksum_index.md5_many(filenames, jobs)
+        typer.echo("indexed {} files ({} already current) in {:.1f}s".format(
+            len(filenames), checksum_index.hits, time.time() - start_time),
+            err=True)
+    typer.echo("{}: {} entries".format(index, len(checksum_index)), err=True)
+
+
+BATCH_COMMANDS = ('cp', 'mv', 'rm', 'mkdir')
+
+
+def _parse_batch_line(line):
+    """Split a manifest line into (command, args).
+
+    A line is either a shell style command line (cp -j 4 a vos:b) or a
+    JSON list of the same words or a JSON object with 'op' and 'args'."""
+    line = line.strip()
+    if line.startswith('['):
+        words = json.loads(line)
+    elif line.startswith('{'):
+        entry = json.loads(line)
+        words = [entry['op']] + list(entry.get('args', []))
+    else:
+        import shlex
+        words = shlex.split(line)
+    words = [str(word) for word in words]
+    if not words or words[0] not in BATCH_COMMANDS:
+        raise ValueError("expected one of {}: {}".format(
+            ", ".join(BATCH_COMMANDS), line))
+    return words[0], words[1:]
+
+
+def _batch_paths(command, args, isdir):
+    """Paths a manifest line reads or writes, as (service, path parts)
+    with any glob pattern cut back to the directory it starts in.
+
+    A cp into an existing directory (checked with isdir) writes the
+    destination/basename of each source, not the directory itself."""
+    ctx = command.make_context(command.name, list(args), resilient_parsing=True)
+    values = []
+    for param in command.params:
+        if param.param_type_name != 'argument':
+            continue
+        value = ctx.params.get(param.name)
+        if value is None:
+            continue
+        values.extend(value if isinstance(value, (list, tuple)) else [value])
+    if command.name == 'cp' and len(values) > 1 and isdir(values[-1]):
+        values[-1:] = [os.path.join(values[-1], os.path.basename(
+            value.rstrip('/'))) for value in values[:-1]]
+    paths = []
+    for value in values:
+        uri = urlparse(value)
+        if uri.scheme:
+            service, path = uri.scheme + '://' + uri.netloc, uri.path
+        else:
+            service, path = 'file', os.path.abspath(value)
+        parts = [part for part in path.split('/') if part]
+        for i, part in enumerate(parts):
+            if glob.has_magic(part):
+                parts = parts[:i]
+                break
+        paths.append((service, tuple(parts)))
+    return paths
+
+
+@app.command()
+def batch(
+    manifest: str = typer.Argument('-', help="file of cp, mv, rm and mkdir command lines (or JSON lines), - for stdin"),
+    jobs: int = typer.Option(8, "-j", "--jobs", min=1, help="number of manifest lines to run concurrently")
+):
+    """Run many cp, mv, rm and mkdir commands in one session.
 
+    Lines run concurrently unless one touches a path at, above or below a
+    path of an earlier line, in which case it waits for that line.  A JSON
+    status for each line is printed as it finishes.
+    """
+    commands = typer.main.get_command(app).commands
+    # made here rather than by the first worker threads to need them
+    client = get_client()
+    node_cache = get_node_cache()
+    get_checksum_index()
+    # the status lines are the only thing on stdout, anything the commands
+    # print (e.g. cp -n) goes to stderr
+    status_out = sys.stdout
+    # (service, path parts) -> unfinished lines that touched it
+    touched = collections.defaultdict(set)
+    # (service, path parts) -> unfinished lines that touched it or below it
+    below = collections.defaultdict(set)
+    waiting = {}
+    dependents = collections.defaultdict(set)
+    output_lock = threading.Lock()
+
+    class Nonlocal:
+        failed = 0
+
+    def emit(status):
+        with output_lock:
+            typer.echo(json.dumps(status), file=status_out)
+
+    def isdir(uri):
+        """Check if a destination is an existing directory"""
+        if not client.is_remote_file(uri):
+            return os.path.isdir(uri)
+        node = node_cache.get(uri)
+        if node is None:
+            try:
+                node = client.get_node(uri, limit=0)
+            except Exception:
+                # missing or unreadable, treated as the path itself
+                return False
+            node_cache.put(uri, node)
+        return node.isdir()
+
+    def run(line_number, command, args):
+        start_time = time.time()
+        status = {'line': line_number, 'op': command.name, 'args': args}
+        try:
+            exit_code = command.main(args, prog_name=command.name,
+                                     standalone_mode=False)
+        except Exception as ex:
+            exit_code = getattr(ex, 'exit_code', 1)
+            status['error'] = ex.format_message() \
+                if hasattr(ex, 'format_message') else str(ex)
+        status['exit_code'] = exit_code or 0
+        status['status'] = 'failed' if exit_code else 'ok'
+        status['seconds'] = round(time.time() - start_time, 3)
+        return status
+
+    def lines():
+        f = sys.stdin if manifest == '-' else open(manifest)
+        try:
+            for line_number, line in enumerate(f, 1):
+                if line.strip() and not line.lstrip().startswith('#'):
+                    yield line_number, line
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    def finished(line_number, paths, ok):
+        for service, parts in paths:
+            keys = [(touched, (service, parts))] + [
+                (below, (service, parts[:i])) for i in range(len(parts) + 1)]
+            for lines_by_path, key in keys:
+                lines_by_path[key].discard(line_number)
+                if not lines_by_path[key]:
+                    del lines_by_path[key]
+        if not ok:
+            Nonlocal.failed += 1
+        ready = []
+        for dependent in dependents.pop(line_number, ()):
+            entry = waiting[dependent]
+            entry[3].discard(line_number)
+            if not ok:
+                entry[4].add(line_number)
+            if not entry[3]:
+                ready.append(dependent)
+        return ready
+
+    def schedule(pool, running, line_number):
+        command, args, paths, _, failed_deps = waiting[line_number]
+        if failed_deps:
+            del waiting[line_number]
+            emit({'line': line_number, 'op': command.name, 'args': args,
+                  'status': 'skipped', 'after_failed': sorted(failed_deps)})
+            return finished(line_number, paths, False)
+        future = pool.submit(run, line_number, command, args)
+        running[future] = line_number
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool, \
+            contextlib.redirect_stdout(sys.stderr):
+        running = {}
+        source = lines()
+        exhausted = False
+        while True:
+            # keep a bounded window of the manifest in memory
+            while not exhausted and len(waiting) < jobs * 4:
+                try:
+                    line_number, line = next(source)
+                except StopIteration:
+                    exhausted = True
+                    break
+                try:
+                    name, args = _parse_batch_line(line)
+                    command = commands[name]
+                    paths = _batch_paths(command, args, isdir)
+                except Exception as ex:
+                    Nonlocal.failed += 1
+                    emit({'line': line_number, 'status': 'failed',
+                          'error': "invalid line: {}".format(ex)})
+                    continue
+                deps = set()
+                for service, parts in paths:
+                    deps |= below[(service, parts)]
+                    for i in range(len(parts) + 1):
+                        deps |= touched[(service, parts[:i])]
+                for service, parts in paths:
+                    touched[(service, parts)].add(line_number)
+                    for i in range(len(parts) + 1):
+                        below[(service, parts[:i])].add(line_number)
+                for dep in deps:
+                    dependents[dep].add(line_number)
+                waiting[line_number] = (command, args, paths, deps, set())
+                if not deps:
+                    ready = [line_number]
+                    while ready:
+                        ready.extend(schedule(pool, running, ready.pop()))
+            if not running:
+                if exhausted:
+                    break
+                continue
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                line_number = running.pop(future)
+                status = future.result()
+                emit(status)
+                paths = waiting.pop(line_number)[2]
+                ready = finished(line_number, paths, status['status'] == 'ok')
+                while ready:
+                    ready.extend(schedule(pool, running, ready.pop()))
+
+    if Nonlocal.failed:
+        raise typer.Exit(1)
 
 if __name__ == "__main__":
     app()
\ No newline at end of file